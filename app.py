@@ -5,17 +5,66 @@
 
 import os
 import dash
+import gzip
+import json
+import flask
+import hashlib
+import plotly
+import tempfile
 import dash_table
-import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output, MATCH, ALL
-from datetime import timedelta, datetime
+from dash.dependencies import Input, Output, State, MATCH, ALL
+from dash.exceptions import PreventUpdate
+from datetime import datetime
+from cache import FigureCache
+from jobs import JobPool
+from dataset import DataNotReady, Reloader
+from metrics import metrics
+from ranking import START_DATE
+from recovery import baseline_range, recovery_frame, recovery_map, recovery_table
 
-app = dash.Dash(__name__, 
+class Dashboard(dash.Dash):
+    """
+    Serves the layout serialized and gzipped once per data version, with an
+    ETag so that browsers revalidate it instead of downloading it again.
+    """
+    _served_layout = (None, None, None, None)
+
+    def serve_layout(self):
+        try:
+            version = reloader.dataset.version
+        except DataNotReady:
+            response = flask.jsonify(reloader.health())
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        if self._served_layout[0] != version:
+            text = json.dumps(self._layout_value(), cls=plotly.utils.PlotlyJSONEncoder).encode()
+            self._served_layout = (version, hashlib.sha1(text).hexdigest(), text, gzip.compress(text))
+        _, etag, text, compressed = self._served_layout
+        response = flask.Response(mimetype='application/json')
+        if 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+            response.set_data(compressed)
+            response.headers['Content-Encoding'] = 'gzip'
+            etag += '-gzip'
+        else:
+            response.set_data(text)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        response.set_etag(etag)
+        return response.make_conditional(flask.request)
+
+    def _layout_value(self):
+        # Dash also builds the layout to validate it on the first request,
+        # which must not wait for the data.
+        if not reloader.ready.is_set():
+            return self.validation_layout
+        return super()._layout_value()
+
+app = Dashboard(__name__, 
                 external_stylesheets=[dbc.themes.FLATLY], 
                 title='MTA Subway Fare Data Visualization')
 server = app.server
@@ -25,103 +74,91 @@ if 'DATA_URL' in os.environ:
 else:
     data_url = 'data/'   			
 
-df = pd.read_csv(data_url + 'main.csv')
-geo_df = pd.read_csv(data_url + 'station_gis.csv')
-
-df.WEEK = df.WEEK.apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
-card_types = df.drop(columns=['WEEK', 'REMOTE', 'STATION']).sum(axis=0).\
-    sort_values(ascending=False).index.tolist()
-stations = df['STATION'].sort_values().unique().tolist()
-week_ending_cur = df.WEEK.max()
-week_ending_old = week_ending_cur - timedelta(weeks= (week_ending_cur.year-2019) * 52)
-start_date = '2020-01-04'  
-
-df_sel = df[df['STATION'].isin(stations)].copy()
-df_sel['row_sum'] = df_sel[card_types].sum(axis=1)
-df_cur = df_sel[df_sel['WEEK']==week_ending_cur][['STATION', 'row_sum']].groupby('STATION', as_index=False).sum() 
-df_old = df_sel[df_sel['WEEK']==week_ending_old][['STATION', 'row_sum']].groupby('STATION', as_index=False).sum()
-df_meg = df_cur.merge(df_old, how='left', on='STATION')
-df_meg['ratio'] = round(df_meg.row_sum_x / df_meg.row_sum_y, 4)
-df_meg['Recent Daily'] = (df_meg['row_sum_x'] / 7).apply(lambda x: '{:,}'.format(int(x) if x == x else 0 ))
-df_meg['Pre-pandemic Daily'] = (df_meg['row_sum_y'] / 7).apply(lambda x: '{:,}'.format(int(x) if x == x else 0))
-df_meg = df_meg.merge(geo_df, how='left', on='STATION')
-df_meg['size'] = df_meg['row_sum_x'].fillna(0) / 7
-df_meg['ratio'] = df_meg['ratio'].fillna(0)
-fig = px.scatter_mapbox(
-    df_meg, lat="lat", lon="lon", size='size', color='ratio', zoom=10,
-    labels={'ratio':'% Recovery'},
-    custom_data=['STATION', 'Pre-pandemic Daily', 'Recent Daily', 'ratio'],
-    range_color=[0, df_meg['ratio'].quantile(0.75)],
-    color_continuous_scale=px.colors.sequential.Blues
-    )        
-fig.update_layout(
-    mapbox_style="carto-positron",
-    margin={"r":0,"t":0,"l":0,"b":0},
-    coloraxis={'colorbar':{'len':0.5, 'x':0, 'tickformat':'.0%', 'yanchor':'top'}}
-    )
-fig.update_traces(
-    hovertemplate=
-        '<b>Station: %{customdata[0]}</b> <br>' + 
-        'Recent Average Daily: %{customdata[2]} <br>' +
-        'Pre-pandemic Daily: %{customdata[1]} <br>' +
-        '% Recovery : %{customdata[3]:.2%}'
-    )    
+if 'CACHE_DIR' in os.environ:
+    cache_dir = os.environ['CACHE_DIR']
+else:
+    cache_dir = os.path.join(tempfile.gettempdir(), 'metrocard-cache')
+
+job_workers = int(os.environ.get('JOB_WORKERS', 1))
+# The job pool maps the cube of the worker rather than holding a copy.
+if 'SHARED_DIR' in os.environ:
+    shared_dir = os.environ['SHARED_DIR']
+elif job_workers:
+    shared_dir = os.path.join(cache_dir, 'shared')
+else:
+    shared_dir = None
+
+figure_cache = FigureCache(cache_dir, int(os.environ.get('CACHE_SIZE', 256)))
+metrics.share(os.path.join(cache_dir, 'metrics'))
+jobs = JobPool(figure_cache, data_url, job_workers, shared_dir,
+               float(os.environ.get('JOB_TIMEOUT', 120)), float(os.environ.get('JOB_WAIT', 0.1)))
+# Forked before the reloader thread starts.
+jobs.start()
+reloader = Reloader(data_url, float(os.environ.get('RELOAD_INTERVAL', 600)), 
+                    shared_dir, float(os.environ.get('LOAD_TIMEOUT', 20)))
+reloader.start()
+start_date = START_DATE
+max_frames = int(os.environ.get('RANKING_FRAMES', 60))
+ALL_STATIONS = -1
+poll_interval = int(os.environ.get('POLL_INTERVAL', 300))
 
 card_class = 'card border-info'
 css_style = {'margin-top':'35px', 'margin-bottom':'75px',
              'margin-left':'75px', 'margin-right':'75px'} 
 
-card_intro_text = dbc.Card([  
-    dbc.CardBody([
-        html.H5('Welcome to the MTA Subway Fare Data Analytics Dashboard',
-                style={'font-weight':'bold'}),
-        html.P([
-            'Last updated: ' + datetime.strftime(week_ending_cur, '%b %d, %Y'),
-            html.Br(),
-            'Data source: ',
-            html.A('http://web.mta.info/developers/fare.html', 
-                   href='http://web.mta.info/developers/fare.html'),
-            html.Br(),
-            'GitHub repository: ',
-            html.A('https://github.com/Tyllis/metrocard-visualization', 
-                   href='https://github.com/Tyllis/metrocard-visualization')
-            ]),
-        html.P([
-            'The New York City Transit subway fare data are based on the number of MetroCard ' +
-            'swipes made each week by customers entering each station of the New York City ' +
-            'Subway, PATH, AirTrain JFK and the Roosevelt Island Tram. The data is released ' +
-            'one week after the recorded week. This dashboard is updated every Sunday when the ' +
-            'new data is released.'
-            ]),
-        html.P([
-            'On the Pandemic Recovery map, the size of the circle shows the relative ' +
-            'volume of MetroCard swipes at each station for the recent week ' +
-            '(larger means more swipes); the color reflects the precent recovery, ' +
-            'calculated by dividing the recent volume by the pre-pandemic ' +
-            'volume. The pre-pandemic data is defined as the 2019 data at the week ' + 
-            'corresponding to recent week. '            
-            ]),
-        html.P([
-            'Explore the map by using the "Box Select" or "Lasso Select" to select ' +
-            'the stations of interest. The Trend, Ranking, and Table will interact ' +
-            'based on the station selection. Clicking on the buttons in the Selected ' +
-            'Stations area toggles the stations on/off. To reset to default selection '+
-            '(all stations), double click on any area on the map.'
-            ]),
-        html.P([
-            'For the trend graph, double click on one of the MetroCard type in the legend to ' +
-            'select the card type of interest; then single click to add additional cards. ' +
-            'Double click again on the legend to reset selection. ' + 
-			'The MetroCard type description can be found ',
-            html.A('here', 
-                   href='http://web.mta.info/developers/resources/nyct/fares/fare_type_description.txt'),
-            '. Explore the ranking graph by dragging the slider to view station ranking ' +
-            'in different time period, or use the play button for an animation through time.'             
+def card_intro_text(data):
+    return dbc.Card([  
+        dbc.CardBody([
+            html.H5('Welcome to the MTA Subway Fare Data Analytics Dashboard',
+                    style={'font-weight':'bold'}),
+            html.P([
+                'Last updated: ' + datetime.strftime(data.week_ending_cur, '%b %d, %Y'),
+                html.Br(),
+                'Data source: ',
+                html.A('http://web.mta.info/developers/fare.html', 
+                       href='http://web.mta.info/developers/fare.html'),
+                html.Br(),
+                'GitHub repository: ',
+                html.A('https://github.com/Tyllis/metrocard-visualization', 
+                       href='https://github.com/Tyllis/metrocard-visualization')
+                ]),
+            html.P([
+                'The New York City Transit subway fare data are based on the number of MetroCard ' +
+                'swipes made each week by customers entering each station of the New York City ' +
+                'Subway, PATH, AirTrain JFK and the Roosevelt Island Tram. The data is released ' +
+                'one week after the recorded week. This dashboard is updated every Sunday when the ' +
+                'new data is released.'
+                ]),
+            html.P([
+                'On the Pandemic Recovery map, the size of the circle shows the relative ' +
+                'volume of MetroCard swipes at each station for the recent week ' +
+                '(larger means more swipes); the color reflects the precent recovery, ' +
+                'calculated by dividing the recent volume by the pre-pandemic ' +
+                'volume. The pre-pandemic data is defined as the 2019 data at the week ' + 
+                'corresponding to recent week. Use the sliders below the map to compare ' +
+                'other recent weeks against other pre-pandemic weeks.'
+                ]),
+            html.P([
+                'Explore the map by using the "Box Select" or "Lasso Select" to select ' +
+                'the stations of interest. The Trend, Ranking, and Table will interact ' +
+                'based on the station selection. Clicking on the buttons in the Selected ' +
+                'Stations area toggles the stations on/off. To reset to default selection '+
+                '(all stations), double click on any area on the map.'
+                ]),
+            html.P([
+                'For the trend graph, double click on one of the MetroCard type in the legend to ' +
+                'select the card type of interest; then single click to add additional cards. ' +
+                'Double click again on the legend to reset selection. ' + 
+    			'The MetroCard type description can be found ',
+                html.A('here', 
+                       href='http://web.mta.info/developers/resources/nyct/fares/fare_type_description.txt'),
+                '. Explore the ranking graph by dragging the slider to view station ranking ' +
+                'in different time period, or use the play button for an animation through time.'             
+                ])
             ])
-        ])
-    ],
-    className=card_class
-    )
+        ],
+        className=card_class
+        )
 
 card_selected_stations = dbc.Card([
     dbc.FormGroup([
@@ -137,45 +174,70 @@ card_selected_stations = dbc.Card([
     className=card_class
     )
 
-card_mapbox = dbc.Card([
-    dbc.CardHeader("NYC Subway Stations Pandemic Recovery Map",
-                   style={'font-weight':'bold'}
-                   ),
-    dbc.CardBody(
-        dcc.Graph(
-            id = 'mapbox_scatter',
-            figure=fig
-            )        
+def week_slider(slider_id, cube, first_week=0, value=None):
+    return dcc.RangeSlider(
+        id=slider_id,
+        min=first_week,
+        max=len(cube.weeks) - 1,
+        value=value or [first_week, len(cube.weeks) - 1],
+        marks={i: str(week.year) for i, week in enumerate(cube.weeks) 
+               if i >= first_week and (i == 0 or cube.weeks[i-1].year != week.year)},
+        allowCross=False
         )
-    ],
-    className=card_class
-    )
 
-card_barplot = dbc.Card([
-    dbc.CardHeader("Stations Ranked by Total MetroCard Swipes",
-                   style={'font-weight':'bold'}
-                   ),
-    dbc.CardBody(
-        dcc.Graph(
-            id = 'bar_plot'
-            )        
+def card_mapbox(data):
+    cube = data.cube
+    last_week = len(cube.weeks) - 1
+    baseline = baseline_range(cube, [last_week, last_week])
+    return dbc.Card([
+        dbc.CardHeader("NYC Subway Stations Pandemic Recovery Map",
+                       style={'font-weight':'bold'}
+                       ),
+        dbc.CardBody([
+            dcc.Graph(
+                id = 'mapbox_scatter',
+                figure=data.fig
+                ),
+            html.Label('Recent weeks'),
+            week_slider('recent_range', cube, value=[last_week, last_week]),
+            html.Label('Pre-pandemic weeks'),
+            week_slider('baseline_range', cube, value=list(baseline) if baseline else [0, 0])
+            ])
+        ],
+        className=card_class
         )
-    ],
-    className=card_class
-    )
 
-card_areaplot = dbc.Card([
-    dbc.CardHeader("Trend for Selected Stations",
-                   style={'font-weight':'bold'}
-                   ),
-    dbc.CardBody(
-        dcc.Graph(
-            id = 'area_plot'
-            )        
+def card_barplot(data):
+    cube = data.cube
+    return dbc.Card([
+        dbc.CardHeader("Stations Ranked by Total MetroCard Swipes",
+                       style={'font-weight':'bold'}
+                       ),
+        dbc.CardBody([
+            dcc.Graph(
+                id = 'bar_plot'
+                ),
+            week_slider('ranking_range', cube, cube.week_id(start_date))
+            ])
+        ],
+        className=card_class
+        )
+
+def card_areaplot(data):
+    cube = data.cube
+    return dbc.Card([
+        dbc.CardHeader("Trend for Selected Stations",
+                       style={'font-weight':'bold'}
+                       ),
+        dbc.CardBody([
+            dcc.Graph(
+                id = 'area_plot'
+                ),
+            week_slider('trend_range', cube, cube.week_id(start_date))
+            ])
+        ],
+        className=card_class
         )
-    ],
-    className=card_class
-    )
 
 card_datatable = dbc.Card([
     dbc.CardHeader("Data Table for Selected Stations",
@@ -189,6 +251,7 @@ card_datatable = dbc.Card([
                                                     'Pre-pandemic Daily', 
                                                     'Recovery Ratio', 'lat', 'lon']],
             page_action='none',
+            virtualization=True,
             fixed_rows={'headers': True},
             style_table={'height': '500px', 'overflowY': 'auto', 'overflowX':'auto'},
             style_cell={'minWidth': 100, 'maxWidth': 120}
@@ -198,60 +261,117 @@ card_datatable = dbc.Card([
     className=card_class
     )
 
-app.layout = html.Div([ 
-    dbc.Row([
-        dbc.Col([
-            dbc.Row(dbc.Col(card_intro_text)),
-            ],
-            md=4
-            ),
-        dbc.Col([
-            dbc.Row(
-                dbc.Col(
-                    dbc.Tabs([
-                        dbc.Tab(card_mapbox, label='Map'),
-                        dbc.Tab(card_areaplot, label='Trend'),
-                        dbc.Tab(card_barplot, label='Ranking'), 
-                        dbc.Tab(card_datatable, label='Table')
-                        ])                    
-                    )
+def layout_stores(data=None):
+    return [
+        dcc.Store(id='map_selection'),
+        dcc.Store(id='selected_station'),
+        dcc.Store(id='button_filtered'),
+        dcc.Store(id='table_data', data=data.table if data else None),
+        dcc.Store(id='bar_job'),
+        dcc.Store(id='area_job'),
+        dcc.Interval(id='bar_poll', interval=poll_interval, disabled=True),
+        dcc.Interval(id='area_poll', interval=poll_interval, disabled=True)
+        ]
+
+def layout_skeleton():
+    # Every component of the callbacks, without the data, so that Dash
+    # validates the callbacks while the data is still loading.
+    return html.Div([
+        dbc.Tabs(id='tabs'),
+        dcc.Graph(id='mapbox_scatter'),
+        dcc.Graph(id='area_plot'),
+        dcc.Graph(id='bar_plot'),
+        *[dcc.RangeSlider(id=slider_id, min=0, max=0)
+          for slider_id in ['recent_range', 'baseline_range', 'trend_range', 'ranking_range']],
+        card_datatable,
+        card_selected_stations
+        ] + layout_stores()
+        )
+
+def serve_layout():
+    data = reloader.dataset
+    return html.Div([ 
+        dbc.Row([
+            dbc.Col([
+                dbc.Row(dbc.Col(card_intro_text(data))),
+                ],
+                md=4
                 ),
-            html.Br(),
-            dbc.Row(dbc.Col(card_selected_stations))
-            ],
-            md=8
-            )
-        ]),
-    
-    dcc.Store(id='selected_station'),
-    dcc.Store(id='button_filtered')   
-    ],
-    style=css_style   
+            dbc.Col([
+                dbc.Row(
+                    dbc.Col(
+                        dbc.Tabs([
+                            dbc.Tab(card_mapbox(data), label='Map', tab_id='map'),
+                            dbc.Tab(card_areaplot(data), label='Trend', tab_id='trend'),
+                            dbc.Tab(card_barplot(data), label='Ranking', tab_id='ranking'), 
+                            dbc.Tab(card_datatable, label='Table', tab_id='table')
+                            ],
+                            id='tabs',
+                            active_tab='map'
+                            )                    
+                        )
+                    ),
+                html.Br(),
+                dbc.Row(dbc.Col(card_selected_stations))
+                ],
+                md=8
+                )
+            ])
+        ] + layout_stores(data),
+        style=css_style   
+        )
+
+app.validation_layout = layout_skeleton()
+app.layout = serve_layout
+
+app.clientside_callback(
+    """
+    function(selected) {
+        if (!selected) {
+            return null;
+        }
+        if (selected.range) {
+            return {range: selected.range.mapbox};
+        }
+        if (selected.lassoPoints) {
+            return {lasso: selected.lassoPoints.mapbox};
+        }
+        return null;
+    }
+    """,
+    Output('map_selection', 'data'),
+    Input('mapbox_scatter', 'selectedData')
     )
 
 @app.callback(
     Output('station_button_group', 'children'),
     Output('selected_station', 'data'),
-    Input('mapbox_scatter', 'selectedData')
+    Input('map_selection', 'data'),
+    State('recent_range', 'value')
     ) 
-def create_buttons(mapbox_selected):
-    if mapbox_selected is None:
-        mapbox_selected = {'points':[]}
-    if len(mapbox_selected['points']) == 0:
-        selected_station = stations
-    else:
-        selected_station = [mapbox_selected['points'][i]['customdata'][0] 
-                            for i in range(len(mapbox_selected['points']))]
-    selected_station.sort()
+@metrics.instrument
+def create_buttons(map_selection, recent_range=None):
+    dataset = reloader.dataset
+    stations = dataset.stations
+    with metrics.phase('filter'):
+        selected_station = dataset.grid.select(map_selection)
+        if selected_station is not None:
+            # Only the stations drawn on the map, with swipes in the recent weeks.
+            cube = dataset.cube
+            recent_range = recent_range or [len(cube.weeks) - 1, len(cube.weeks) - 1]
+            selected_station = selected_station[cube.range_totals(*recent_range, selected_station) > 0]
+    if selected_station is None or len(selected_station) == 0:
+        selected_station = range(len(stations))
+    selected_station = sorted(set(map(int, selected_station)), key=lambda i: stations[i])
     button_list = []
-    if set(selected_station) == set(stations):
-        selected_station = ['ALL STATIONS']
+    if len(selected_station) == len(stations):
+        selected_station = [ALL_STATIONS]
         button = dbc.Button('ALL STATIONS', outline=True, color="success", size='sm',
-                            className="mr-1", n_clicks=0, id={'type':'station_button', 'index':'ALL STATIONS'})
+                            className="mr-1", n_clicks=0, id={'type':'station_button', 'index':ALL_STATIONS})
         button_list.append(button)
     else:
         for station in selected_station:
-            button = dbc.Button(station, outline=True, color="success", size='sm',
+            button = dbc.Button(stations[station], outline=True, color="success", size='sm',
                                 className="mr-1", n_clicks=0, id = {'type':'station_button', 'index':station})
             button_list.append(button)             
     return button_list, selected_station
@@ -273,109 +393,162 @@ def button_color_change(clicks):
     Input('selected_station', 'data'),
     Input({'type':'station_button', 'index':ALL}, 'n_clicks')
     )
+@metrics.instrument
 def button_filter(selected_station, clicks):    
     even_clicks_idx = [idx for idx, val in enumerate(clicks) if val % 2 ==0]
     filtered_station = [selected_station[idx] for idx in even_clicks_idx]       
-    if 'ALL STATIONS' in filtered_station:
-        filtered_station = stations
+    if ALL_STATIONS in filtered_station:
+        filtered_station = list(range(len(reloader.dataset.stations)))
     return filtered_station
 
+def stop_polling(job):
+    """
+    Stops the polling of a figure whose tab was left, otherwise prevents the
+    update.
+    """
+    if job is None:
+        raise PreventUpdate
+    metrics.payload(0)
+    return dash.no_update, None, True
+
+def background_figure(name, job, selected_station, *args):
+    """
+    Returns the figure, job and poll outputs of a figure computed on the job
+    pool: the figure once the job is done, otherwise no figure update and
+    the job to poll, until the figure is in the cache.
+    """
+    dataset = reloader.dataset
+    key = figure_cache.key(dataset.version, name, selected_station, *args)
+    polling = job is not None and job['key'] == key
+    status, result = jobs.submit(key, name, dataset.version, [selected_station] + list(args),
+                                 dataset, polling)
+    if status == 'stale':
+        # The job found newer data and cached the figure under its version,
+        # the reloader picks that version up off the request path.
+        reloader.wake()
+        result = figure_cache.get(result + key[len(dataset.version):])
+        status = 'running' if result is None else 'done'
+    if status == 'running':
+        metrics.payload(0)
+        if polling:
+            return dash.no_update, dash.no_update, dash.no_update
+        return dash.no_update, {'key': key}, False
+    if status == 'failed':
+        return go.Figure(data=[go.Scatter(x=[],y=[])]), None, True
+    metrics.payload(len(result))
+    return json.loads(result), None, True
+
 @app.callback(
     Output('bar_plot', 'figure'),
-    Input('button_filtered', 'data')
+    Output('bar_job', 'data'),
+    Output('bar_poll', 'disabled'),
+    Input('button_filtered', 'data'),
+    Input('ranking_range', 'value'),
+    Input('tabs', 'active_tab'),
+    Input('bar_poll', 'n_intervals'),
+    State('bar_job', 'data')
     )
-def create_barplot(selected_station):
+@metrics.instrument
+def create_barplot(selected_station, week_range=None, active_tab='ranking', n_intervals=None, job=None):
+    if active_tab != 'ranking':
+        return stop_polling(job)
     if len(selected_station) == 0:
-        return go.Figure(data=[go.Scatter(x=[],y=[])])
-    num_bars = 15
-    cols = ['WEEK', 'REMOTE', 'STATION'] + card_types
-    tmp = df[df['STATION'].isin(selected_station)][cols].copy() 
-    tmp = tmp[tmp['WEEK'] >= datetime.strptime(start_date, '%Y-%m-%d')]
-    tmp = tmp.groupby(['WEEK', 'STATION'], as_index=False).sum()
-    tmp = pd.melt(tmp, id_vars=['WEEK', 'STATION'], value_vars=card_types, var_name='card_type', value_name='swipes')
-    tmp = tmp.groupby(['WEEK', 'STATION'], as_index=False).sum()
-    tmp_ = tmp.groupby('WEEK')['swipes'].nlargest(num_bars)
-    try:
-        time, indx = zip(*tmp_.index.tolist())
-    except:
-        indx = tmp_.index.tolist()
-    tmp = tmp.iloc[list(indx)]
-    tmp.WEEK = tmp.WEEK.apply(lambda x: '{:%Y-%m-%d}'.format(x))
-    tmp = tmp.reset_index(drop=True)
-    tmp['swipes'] = (tmp['swipes'] / 7).astype('int')
-    max_range = tmp.groupby(['WEEK', 'STATION'], as_index=False)['swipes'].sum()['swipes'].max()
-    
-    fig = px.bar(
-        tmp, y = 'STATION', x = 'swipes', animation_frame = 'WEEK', 
-        range_x=[0,max_range], orientation='h', template='seaborn',
-        labels={'STATION':'Station Name',
-                'WEEK': 'Week Ending',
-                'swipes':'Average Daily MetroCard Swipes'},
-        custom_data=['STATION', 'WEEK', 'swipes']
-        )
-    fig.update_layout(
-        yaxis=dict(autorange="reversed"))
-    
-    fig.update_traces(
-        hovertemplate=
-            'Station: %{customdata[0]} <br>' +
-            'Week Ending: %{customdata[1]} <br>' +
-            'Swipes: %{customdata[2]:,}<extra></extra>'
-        )
-    fig.update_layout(
-		margin={"r":0,"t":0,"l":0,"b":0}
-		)
-    return fig
+        return go.Figure(data=[go.Scatter(x=[],y=[])]), None, True
+    if week_range is None:
+        cube = reloader.dataset.cube
+        week_range = [cube.week_id(start_date), len(cube.weeks) - 1]
+    return background_figure('create_barplot', job, selected_station, week_range, max_frames)
 
 @app.callback(
     Output('area_plot', 'figure'),
-    Input('button_filtered', 'data')
+    Output('area_job', 'data'),
+    Output('area_poll', 'disabled'),
+    Input('button_filtered', 'data'),
+    Input('trend_range', 'value'),
+    Input('tabs', 'active_tab'),
+    Input('area_poll', 'n_intervals'),
+    State('area_job', 'data')
     )
-def create_areaplot(selected_station):    
+@metrics.instrument
+def create_areaplot(selected_station, week_range=None, active_tab='trend', n_intervals=None, job=None):    
+    if active_tab != 'trend':
+        return stop_polling(job)
     if len(selected_station) == 0:
-        return go.Figure(data=[go.Scatter(x=[],y=[])])
-    cols = ['WEEK', 'REMOTE', 'STATION'] + card_types
-    tmp = df[df['STATION'].isin(selected_station)][cols].copy() 
-    tmp = tmp[tmp['WEEK'] >= datetime.strptime(start_date, '%Y-%m-%d')]
-    tmp = tmp.groupby('WEEK', as_index=False).sum()
-    tmp = pd.melt(tmp, id_vars=['WEEK'], value_vars=card_types, var_name='card_type', value_name='swipes')
-    tmp.WEEK = tmp.WEEK.apply(lambda x: '{:%Y-%m-%d}'.format(x))
-    sorted_cards = tmp.groupby('card_type', as_index=False).mean().\
-        sort_values('swipes', ascending=False).card_type.tolist()
-    tmp = tmp.set_index('card_type').loc[sorted_cards]
-    tmp = tmp.reset_index()
-    tmp['swipes'] = (tmp['swipes'] / 7).astype('int')
-    fig = px.area(
-        tmp, x='WEEK', y='swipes', color='card_type', template='seaborn',
-        labels={'card_type':'MetroCard Type', 
-                'WEEK':'Date',
-                'swipes':'Average Daily MetroCard Swipes'},
-        custom_data=['card_type', 'swipes', 'WEEK']
-        )
-    fig.update_xaxes(spikemode='across', spikethickness=1)
-    fig.update_traces(
-        hovertemplate=
-            '<b>MetroCard Type: %{customdata[0]}</b> <br>' +
-            'MetroCard Swipes: %{customdata[1]:,} <br>' +
-            'Week Ending: %{customdata[2]}<extra></extra>'
-        )
-    fig.update_layout(
-        margin={"r":0,"t":0,"l":0,"b":0}
-        )
-    return fig
+        return go.Figure(data=[go.Scatter(x=[],y=[])]), None, True
+    if week_range is None:
+        cube = reloader.dataset.cube
+        week_range = [cube.week_id(start_date), len(cube.weeks) - 1]
+    return background_figure('create_areaplot', job, selected_station, week_range)
 
 @app.callback(
+    Output('mapbox_scatter', 'figure'),
+    Output('table_data', 'data'),
+    Input('recent_range', 'value'),
+    Input('baseline_range', 'value'),
+    prevent_initial_call=True
+    )
+@metrics.instrument
+@figure_cache.memoize(lambda: reloader.dataset.version)
+def update_recovery(week_range, baseline):
+    dataset = reloader.dataset
+    with metrics.phase('aggregate'):
+        df_meg = recovery_frame(dataset.cube, dataset.geo_df, week_range, baseline)
+    if len(df_meg) == 0:
+        return go.Figure(), recovery_table(df_meg)
+    with metrics.phase('figure'):
+        fig = recovery_map(df_meg)
+    return fig, recovery_table(df_meg)
+
+app.clientside_callback(
+    """
+    function(selected, table, active_tab) {
+        if (active_tab !== 'table') {
+            return window.dash_clientside.no_update;
+        }
+        if (!selected || !table) {
+            return [];
+        }
+        var ids = new Set(selected);
+        var columns = Object.keys(table);
+        var rows = [];
+        for (var i = 0; i < table.ID.length; i++) {
+            if (ids.has(table.ID[i])) {
+                var row = {};
+                columns.forEach(function(column) { row[column] = table[column][i]; });
+                rows.push(row);
+            }
+        }
+        return rows;
+    }
+    """,
     Output('table', 'data'),
-    Input('button_filtered', 'data')
+    Input('button_filtered', 'data'),
+    Input('table_data', 'data'),
+    Input('tabs', 'active_tab')
     )
-def create_table(selected_station):   
-    selected_df = df_meg[df_meg.STATION.isin(selected_station)].copy()
-    selected_df = selected_df[['STATION', 'Recent Daily', 'Pre-pandemic Daily', 'ratio', 'lat', 'lon', 'wiki']]
-    selected_df = selected_df.rename(columns={'STATION':'Station', 'ratio':'Recovery Ratio', 'wiki':'Wikipedia Link'})
-    selected_df.lat = selected_df.lat.round(decimals=5)
-    selected_df.lon = selected_df.lon.round(decimals=5)
-    selected_df = selected_df.to_dict(orient='records')
-    return selected_df
+
+@server.route('/cache')
+def cache_stats():
+    return flask.jsonify(figure_cache.stats())
+
+@server.route('/health')
+def health():
+    return flask.jsonify(reloader.health())
+
+@server.route('/jobs')
+def job_stats():
+    return flask.jsonify(jobs.stats())
+
+@server.route('/ready')
+def ready():
+    status = reloader.health()
+    return flask.jsonify(status), 200 if status['ready'] else 503
+
+@server.route('/metrics')
+def metrics_stats():
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        flask.abort(403)
+    return flask.jsonify(metrics.snapshot())
 
 if __name__ == '__main__':
     app.run_server()
\ No newline at end of file
@@ -0,0 +1,879 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Benchmarks for the data pipeline and the dashboard, run against the real data
+when available or against synthetic weekly fare data of a chosen size.
+
+    python benchmark.py startup --weeks 300 --stations 450
+    python benchmark.py startup --csv data/main.csv
+    python benchmark.py boot --weeks 300 --stations 450
+    python benchmark.py contention --weeks 600 --stations 450
+    python benchmark.py callbacks --weeks 300 --stations 450
+    python benchmark.py combine --weeks 500 --stations 450
+    python benchmark.py recovery --weeks 300 --stations 450
+    python benchmark.py encoding --weeks 300 --stations 450
+    python benchmark.py memory --weeks 300 --stations 450
+    python benchmark.py pipeline --weeks 300 --stations 450
+    python benchmark.py suite --weeks 300 --stations 450 --output results.json
+    python benchmark.py compare old.json new.json
+
+Every run saves its results as JSON, tagged with the git commit, under
+benchmarks/ unless --output is given, so that runs on different commits can
+be compared.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import contextlib
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import numpy as np
+import pandas as pd
+import jobs
+import store
+import utilities as util
+from cube import WeeklyCube
+from recovery import recovery_frame, recovery_map
+from datetime import timedelta, datetime
+
+CARD_TYPES = ['FF', 'SEN/DIS', '7-D AFAS UNL', 'D AFAS/RMF I', 'JOINT RR TKT',
+              '7-D UNL', '30-D UNL', '14-D RFM UNL', '1-D UNL', '14-D UNL',
+              '7D-XBUS PASS', 'TCMC', 'RF 2 TRIP', 'RR UNL NO TRADE',
+              'TCMC ANNUAL MC', 'MR EZPAY EXP', 'MR EZPAY UNL', 'PATH 2-T',
+              'AIRTRAIN FF', 'AIRTRAIN 30-D', 'AIRTRAIN 10-T', 'AIRTRAIN MTHLY',
+              'STUDENTS', 'NICE 2-T', 'CUNY-120', 'CUNY-60', 'FF VALUE',
+              'FF 7-DAY', 'FF 30-DAY']
+FIRST_WEEK = '2019-01-05'
+GIS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'station_gis.csv')
+LOAD_TIMEOUT = 300
+
+
+def station_names(num_stations, gis_file=GIS_FILE):
+    names = []
+    if os.path.exists(gis_file):
+        names = pd.read_csv(gis_file)['STATION'].tolist()
+    names += ['STATION {:04d}'.format(i) for i in range(max(0, num_stations - len(names)))]
+    return sorted(names[:num_stations])
+
+
+def synthetic_frame(num_weeks, num_stations, seed=0):
+    """
+    Parameters
+    ----------
+    num_weeks : int
+        Number of weeks, starting from FIRST_WEEK.
+    num_stations : int
+        Number of stations. Every third station gets a second REMOTE.
+    seed : int, optional
+        Random seed. The default is 0.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Main data frame in the main.csv layout.
+    """
+    rng = np.random.default_rng(seed)
+    names = station_names(num_stations)
+    stations = [name for i, name in enumerate(names) for _ in range(1 + (i % 3 == 0))]
+    remotes = ['R{:04d}'.format(i) for i in range(len(stations))]
+    scale = rng.lognormal(8, 1, size=(len(stations), len(CARD_TYPES))).astype('int')
+    first = datetime.strptime(FIRST_WEEK, '%Y-%m-%d')
+    frames = []
+    for i in range(num_weeks):
+        counts = rng.poisson(scale)
+        week = pd.DataFrame(counts, columns=CARD_TYPES)
+        week.insert(0, 'STATION', stations)
+        week.insert(0, 'REMOTE', remotes)
+        week['WEEK'] = '{:%Y-%m-%d}'.format(first + timedelta(weeks=i))
+        frames.append(week)
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_raw_files(df, save_dir):
+    """
+    Write a main data frame as one fares_YYMMDD.csv file per week in the
+    layout published by the MTA: two title rows before the header, padded
+    column names, stations and counts, and a trailing blank column.
+
+    Returns
+    -------
+    report_weeks : list
+        Posting dates of the files written.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    report_weeks = []
+    for week, df_week in df.groupby('WEEK'):
+        week = datetime.strptime(week, '%Y-%m-%d')
+        report_week = week + timedelta(days=7)
+        cards = [column for column in df_week.columns if column not in ['REMOTE', 'STATION', 'WEEK']]
+        columns = [df_week['REMOTE'], df_week['STATION'].str.ljust(40)]
+        columns += [df_week[card].astype('str').str.rjust(12) for card in cards]
+        lines = columns[0].str.cat(columns[1:], sep=',') + ',' + ' ' * 6
+        with open(os.path.join(save_dir, 'fares_{:%y%m%d}.csv'.format(report_week)), 'w') as f:
+            f.write('Fare Card History for Metropolitan Transportation Authority\n')
+            f.write('From: {:%m/%d/%Y} To: {:%m/%d/%Y}\n'.format(week - timedelta(days=6), week))
+            f.write(','.join(['REMOTE', ' STATION'] + [' ' + card for card in cards] + [' ' * 6]) + '\n')
+            f.write('\n'.join(lines) + '\n')
+        report_weeks.append(report_week)
+    return report_weeks
+
+
+def write_weekly_files(df, save_dir):
+    """
+    Write a main data frame as raw MTA files in save_dir/raw and convert them
+    to YYMMDD.csv files with utilities.download_week, which reads the raw
+    file kept on disk instead of downloading it.
+    """
+    for report_week in write_raw_files(df, os.path.join(save_dir, 'raw')):
+        util.download_week(None, report_week, save_dir)
+
+
+def timeit(func, repeat=3):
+    """
+    Returns the best wall time in seconds of func() over repeat runs.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_startup(csv_file, store_dir):
+    """
+    Compare the startup load of main.csv against the columnar store.
+    """
+    def load_csv():
+        df = pd.read_csv(csv_file)
+        df.WEEK = df.WEEK.apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
+        return df
+    results = {
+        'csv_seconds': timeit(load_csv),
+        'store_seconds': timeit(lambda: store.read_store(store_dir)),
+        'csv_megabytes': load_csv().memory_usage(deep=True).sum() / 2**20,
+        'store_megabytes': store.read_store(store_dir).memory_usage(deep=True).sum() / 2**20
+        }
+    for key, value in results.items():
+        print('{:<20}{:>10.3f}'.format(key, value))
+    return results
+
+
+def bench_callbacks(data_dir, sizes=(1, 50, None)):
+    """
+    Time every callback of the dashboard for selections of the given number
+    of stations (None for all stations) against the data in data_dir. The
+    figure callbacks are timed both uncached and served from the figure cache.
+    """
+    os.environ['DATA_URL'] = data_dir.rstrip('/') + '/'
+    os.environ['CACHE_DIR'] = os.path.join(data_dir, 'cache')
+    os.environ['JOB_WORKERS'] = '0'
+    sys.modules.pop('app', None)
+    import app
+    if not app.reloader.wait(LOAD_TIMEOUT):
+        raise RuntimeError('Data not loaded in {} seconds: {}'.format(LOAD_TIMEOUT, app.reloader.error))
+    results = {'button_color_change': timeit(lambda: app.button_color_change(1))}
+    print('{:<28}{:>10.3f}'.format('button_color_change', results['button_color_change']))
+    for size in sizes:
+        selected = list(range(len(app.reloader.dataset.stations)))[:size]
+        mapped = app.reloader.dataset.df_meg.dropna(subset=['lon', 'lat']).iloc[:size]
+        map_selection = {'range': [[mapped['lon'].min(), mapped['lat'].min()], 
+                                   [mapped['lon'].max(), mapped['lat'].max()]]}
+        clicks = [0] * len(selected)
+        for name, func in [('create_buttons', lambda: app.create_buttons(map_selection)),
+                           ('button_filter', lambda: app.button_filter(selected, clicks))]:
+            key = '{}_{}'.format(name, size or 'all')
+            results[key] = timeit(func)
+            print('{:<28}{:>10.3f}'.format(key, results[key]))
+        for callback in [app.create_areaplot, app.create_barplot]:
+            key = '{}_{}'.format(callback.__name__, size or 'all')
+            results[key] = timeit(lambda: jobs.run(callback.__name__, app.reloader.dataset, selected))
+            results[key + '_cached'] = timeit(lambda: callback(selected))
+            print('{:<28}{:>10.3f}{:>10.3f}'.format(key, results[key], results[key + '_cached']))
+    return results
+
+
+def bench_app_startup(data_dir, repeat=3):
+    """
+    Time the import of the app and the loading of its data in a fresh
+    interpreter.
+    """
+    env = dict(os.environ, DATA_URL=data_dir.rstrip('/') + '/',
+               CACHE_DIR=os.path.join(data_dir, 'cache'))
+    env.pop('SHARED_DIR', None)
+    code = ('import time; start = time.perf_counter(); import app; imported = time.perf_counter() - start; '
+            'loaded = app.reloader.wait({}); print(imported, time.perf_counter() - start); '
+            'assert loaded, app.reloader.error').format(LOAD_TIMEOUT)
+    import_best, best = float('inf'), float('inf')
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-c', code], env=env,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode:
+            raise RuntimeError('Data not loaded in {} seconds: {}'.format(
+                LOAD_TIMEOUT, process.stderr.decode().strip().splitlines()[-1]))
+        imported, loaded = map(float, process.stdout.split()[-2:])
+        import_best, best = min(import_best, imported), min(best, loaded)
+    results = {'app_import': import_best, 'app_startup': best}
+    for key, value in results.items():
+        print('{:<20}{:>10.3f}'.format(key, value))
+    return results
+
+
+def http(base_url, path, payload=None, timeout=60):
+    """
+    Returns the status, body and compressed size of a GET, or of a POST of
+    payload as JSON.
+    """
+    data = None if payload is None else json.dumps(payload).encode()
+    request = urllib.request.Request(base_url + path, data=data, headers={
+        'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, body, encoding = response.status, response.read(), response.headers.get('Content-Encoding')
+    except urllib.error.HTTPError as e:
+        status, body, encoding = e.code, e.read(), e.headers.get('Content-Encoding')
+    size = len(body)
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    return status, body, size
+
+
+def component_key(component_id):
+    return component_id if isinstance(component_id, str) else json.dumps(component_id, sort_keys=True)
+
+
+def collect_components(node, props):
+    """
+    Index the props of every component with an id in a layout tree.
+    """
+    if isinstance(node, list):
+        for child in node:
+            collect_components(child, props)
+    elif isinstance(node, dict):
+        if 'props' in node and 'type' in node:
+            if 'id' in node['props']:
+                props[component_key(node['props']['id'])] = node['props']
+            collect_components(list(node['props'].values()), props)
+        else:
+            collect_components(list(node.values()), props)
+
+
+def resolve(dependency, props):
+    """
+    Returns the callback argument of an input or state in the renderer
+    format, None when its component is not in the page or it uses MATCH.
+    """
+    if not dependency['id'].startswith('{'):
+        if dependency['id'] not in props:
+            return None
+        return {'id': dependency['id'], 'property': dependency['property'],
+                'value': props[dependency['id']].get(dependency['property'])}
+    pattern = json.loads(dependency['id'])
+    if any(value in (['MATCH'], ['ALLSMALLER']) for value in pattern.values()):
+        return None
+    matches = []
+    for key, component_props in props.items():
+        if key.startswith('{'):
+            component_id = json.loads(key)
+            if component_id.keys() == pattern.keys() and all(
+                    value == ['ALL'] or component_id[name] == value for name, value in pattern.items()):
+                matches.append({'id': component_id, 'property': dependency['property'],
+                                'value': component_props.get(dependency['property'])})
+    return matches
+
+
+def page_load(base_url):
+    """
+    Replay the requests of the Dash renderer opening the page: the index,
+    the layout, the callback graph, then every server callback fired by the
+    initial load, each after the callbacks it depends on, until no output
+    changes. Clientside callbacks are skipped.
+
+    Returns
+    -------
+    results : dict
+        Seconds taken, number of requests and compressed bytes received.
+    """
+    start = time.perf_counter()
+    size = http(base_url, '/')[2]
+    status, body, layout_size = http(base_url, '/_dash-layout')
+    size += layout_size
+    props = {}
+    collect_components(json.loads(body), props)
+    callbacks = [callback for callback in json.loads(http(base_url, '/_dash-dependencies')[1])
+                 if callback.get('clientside_function') is None]
+    for callback in callbacks:
+        output = callback['output']
+        parts = output[2:-2].split('...') if output.startswith('..') else [output]
+        callback['outputs'] = [dict(zip(['id', 'property'], part.rsplit('.', 1))) for part in parts]
+    pending = [callback for callback in callbacks if not callback.get('prevent_initial_call')]
+    requests = 3
+    while pending and requests < 100:
+        upstream = {(o['id'], o['property']) for callback in pending for o in callback['outputs']}
+        callback = next((callback for callback in pending if not any(
+            (i['id'], i['property']) in upstream for i in callback['inputs'])), pending[0])
+        pending.remove(callback)
+        inputs = [resolve(i, props) for i in callback['inputs']]
+        if any(i is None for i in inputs):
+            continue
+        outputs = callback['outputs'] if len(callback['outputs']) > 1 else callback['outputs'][0]
+        status, body, response_size = http(base_url, '/_dash-update-component', {
+            'output': callback['output'], 'outputs': outputs, 'inputs': inputs,
+            'state': [resolve(s, props) for s in callback['state']], 'changedPropIds': []})
+        requests += 1
+        size += response_size
+        if status != 200:
+            continue
+        changed, known = set(), set(props)
+        for component_id, values in json.loads(body)['response'].items():
+            props.setdefault(component_id, {}).update(values)
+            changed.update((component_id, name) for name in values)
+            collect_components(list(values.values()), props)
+        created = any(key.startswith('{') for key in set(props) - known)
+        for other in callbacks:
+            if other in pending:
+                continue
+            patterns = any(i['id'].startswith('{') for i in other['inputs'])
+            if any((i['id'], i['property']) in changed for i in other['inputs']) or (
+                    created and patterns and not other.get('prevent_initial_call')):
+                pending.append(other)
+    return {'seconds': time.perf_counter() - start, 'requests': requests, 'bytes': size}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def bench_boot(data_dir, repeat=3, timeout=300):
+    """
+    Start a gunicorn worker and time how long it takes to answer its first
+    request (worker boot), to have its data loaded (ready), and to serve the
+    initial page load, see page_load.
+    """
+    env = dict(os.environ, DATA_URL=data_dir.rstrip('/') + '/',
+               CACHE_DIR=os.path.join(data_dir, 'cache'))
+    env.pop('SHARED_DIR', None)
+    runs = []
+    for _ in range(repeat):
+        shutil.rmtree(env['CACHE_DIR'], ignore_errors=True)
+        port = free_port()
+        base_url = 'http://127.0.0.1:{}'.format(port)
+        start = time.perf_counter()
+        master = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--workers', '1', '--timeout', str(timeout),
+             '--bind', '127.0.0.1:{}'.format(port), 'app:server'],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            run = {}
+            while time.perf_counter() - start < timeout:
+                try:
+                    status = http(base_url, '/health', timeout=timeout)[0]
+                except OSError:
+                    time.sleep(0.05)
+                    continue
+                run.setdefault('worker_boot', time.perf_counter() - start)
+                if status == 200 and http(base_url, '/ready', timeout=timeout)[0] in (200, 404):
+                    break
+                time.sleep(0.05)
+            run['ready'] = time.perf_counter() - start
+            page = page_load(base_url)
+            run.update(page_load=page['seconds'], page_requests=page['requests'], page_bytes=page['bytes'])
+            runs.append(run)
+        finally:
+            master.terminate()
+            master.wait()
+    results = {key: min(run[key] for run in runs) for key in runs[0]}
+    for key, value in results.items():
+        print('{:<20}{:>10.3f}'.format(key, value))
+    return results
+
+
+def figure_request(base_url, callback, values, poll_interval=0.3, timeout=120):
+    """
+    Request a figure callback with the given input and state values by
+    component id, polling it like the browser while the response hands a
+    job over (figure not updated, job store set).
+
+    Returns
+    -------
+    seconds : float
+        Time until the figure is received.
+    requests : int
+        Number of requests sent.
+    """
+    start = time.perf_counter()
+    output = callback['output']
+    parts = output[2:-2].split('...') if output.startswith('..') else [output]
+    outputs = [dict(zip(['id', 'property'], part.rsplit('.', 1))) for part in parts]
+    values = dict(values)
+    requests = 0
+    while time.perf_counter() - start < timeout:
+        status, body, _ = http(base_url, '/_dash-update-component', {
+            'output': output, 'outputs': outputs if len(outputs) > 1 else outputs[0],
+            'inputs': [dict(i, value=values.get(i['id'])) for i in callback['inputs']],
+            'state': [dict(s, value=values.get(s['id'])) for s in callback.get('state', [])],
+            'changedPropIds': []})
+        requests += 1
+        response = json.loads(body)['response'] if status == 200 else {}
+        figure = next((o['id'] for o in outputs if o['property'] == 'figure'), None)
+        if figure in response:
+            break
+        job = next((o['id'] for o in outputs if o['id'].endswith('_job')), None)
+        poll = next((i['id'] for i in callback['inputs'] if i['property'] == 'n_intervals'), None)
+        if job is None or poll is None or status != 200:
+            break
+        if job in response:
+            values[job] = response[job]['data']
+        values[poll] = (values.get(poll) or 0) + 1
+        time.sleep(poll_interval)
+    return time.perf_counter() - start, requests
+
+
+def percentiles(values):
+    values = np.sort(values)
+    return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+            'max': float(values[-1]), 'count': len(values)}
+
+
+def bench_contention(data_dir, workers=2, clients=8, duration=10, timeout=300):
+    """
+    Start gunicorn with the given number of sync workers and let clients
+    request uncached Ranking figures for all stations in a loop, while a
+    probe clicks a station button. Reports the latency of the button clicks,
+    the time until each figure is received, and how many jobs the pool ran
+    when all clients ask for the same figure at once.
+    """
+    env = dict(os.environ, DATA_URL=data_dir.rstrip('/') + '/',
+               CACHE_DIR=os.path.join(data_dir, 'cache'))
+    env.pop('SHARED_DIR', None)
+    shutil.rmtree(env['CACHE_DIR'], ignore_errors=True)
+    port = free_port()
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    master = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--timeout', str(timeout),
+         '--bind', '127.0.0.1:{}'.format(port), 'app:server'],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if http(base_url, '/ready')[0] in (200, 404) and http(base_url, '/health')[0] == 200:
+                    break
+            except OSError:
+                pass
+            time.sleep(0.1)
+        for _ in range(workers * 4):
+            http(base_url, '/_dash-layout')
+        callbacks = json.loads(http(base_url, '/_dash-dependencies')[1])
+        barplot = next(c for c in callbacks if 'bar_plot.figure' in c['output'])
+        button = next(c for c in callbacks if 'station_button' in c['output'])
+        num_weeks = json.loads(http(base_url, '/health')[1])['weeks']
+        num_stations = json.loads(http(base_url, '/health')[1])['stations']
+        values = {'button_filtered': list(range(num_stations)), 'tabs': 'ranking'}
+        results = {}
+
+        stop = time.perf_counter() + duration
+        figures, clicks = [], []
+        lock = threading.Lock()
+
+        def client(seed):
+            rng = np.random.RandomState(seed)
+            while time.perf_counter() < stop:
+                first = int(rng.randint(0, num_weeks // 2))
+                seconds, _ = figure_request(base_url, barplot, dict(values, ranking_range=[first, num_weeks - 1]))
+                with lock:
+                    figures.append(seconds)
+
+        threads = [threading.Thread(target=client, args=(seed,)) for seed in range(clients)]
+        for thread in threads:
+            thread.start()
+        button_id = {'index': 0, 'type': 'station_button'}
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            http(base_url, '/_dash-update-component', {
+                'output': button['output'], 'outputs': {'id': button_id, 'property': 'color'},
+                'inputs': [{'id': button_id, 'property': 'n_clicks', 'value': 1}],
+                'state': [], 'changedPropIds': []})
+            clicks.append(time.perf_counter() - start)
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        results['button_click'] = percentiles(clicks)
+        results['figure'] = percentiles(figures)
+
+        def job_stats():
+            # Each worker counts its own jobs, ask until every worker answered.
+            stats = {}
+            for _ in range(workers * 10):
+                status, body, _ = http(base_url, '/jobs')
+                if status != 200 or not body.startswith(b'{'):
+                    return None
+                worker = json.loads(body)
+                stats[worker['pid']] = worker
+                if len(stats) == workers:
+                    break
+            return {'submitted': sum(worker['submitted'] for worker in stats.values())}
+
+        before = job_stats()
+        same = dict(values, ranking_range=[1, num_weeks - 2])
+        threads = [threading.Thread(target=figure_request, args=(base_url, barplot, same)) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results['identical'] = {'seconds': time.perf_counter() - start}
+        if before is not None:
+            after = job_stats()
+            results['identical']['jobs'] = after['submitted'] - before['submitted']
+    finally:
+        master.terminate()
+        master.wait()
+    for name in ['button_click', 'figure']:
+        print('{:<14}'.format(name) + ''.join('{:>8} {:<8.3f}'.format(k, v) for k, v in results[name].items()))
+    print('{:<14}{:>8.3f} s'.format('identical', results['identical']['seconds']),
+          results['identical'].get('jobs', ''))
+    return results
+
+
+def bench_combine(files_dir, processes=(1, None)):
+    """
+    Time utilities.combine_all over the weekly files in files_dir, serially
+    and with a process pool.
+    """
+    results = {}
+    for num in processes:
+        start = time.perf_counter()
+        df, report = util.combine_all(files_dir, processes=num)
+        key = 'combine_all_processes_{}'.format(num or os.cpu_count())
+        results[key] = time.perf_counter() - start
+        print('{:<32}{:>10.3f}'.format(key, results[key]))
+    results['files'] = len(report)
+    results['file_seconds_mean'] = report['seconds'].mean()
+    results['file_seconds_max'] = report['seconds'].max()
+    results['errors'] = int(report['error'].notna().sum())
+    for key in ['files', 'file_seconds_mean', 'file_seconds_max', 'errors']:
+        print('{:<32}{:>10.3f}'.format(key, results[key]))
+    return results
+
+
+def bench_pipeline(df, files_dir, tmp):
+    """
+    Time the ingestion functions of utilities over the weekly files written
+    from df into files_dir: adding the last week to the previous weeks held
+    in memory and in a store, combining every file, and read_data from the
+    weekly files (building the store) and from the store.
+    """
+    file_names = sorted(file for file in os.listdir(files_dir) if file.endswith('.csv'))
+    last_file = os.path.join(files_dir, file_names[-1])
+    df_prev = store.normalize_frame(df[df['WEEK'] < df['WEEK'].max()])
+    prev_dir = os.path.join(tmp, 'store_prev')
+    store.write_store(df_prev, prev_dir)
+    shutil.copytree(prev_dir, prev_dir + '_append')
+    data_dir = os.path.join(tmp, 'read_data')
+
+    def read_data_files():
+        shutil.rmtree(data_dir, ignore_errors=True)
+        return util.read_data(os.path.join(data_dir, 'main.csv'), files_dir, data_dir)
+
+    with contextlib.redirect_stdout(None):
+        results = {
+            'add_data_frame': timeit(lambda: util.add_data(df_prev, last_file)),
+            'add_data_store': timeit(lambda: util.add_data(prev_dir, last_file)),
+            'append_data': timeit(lambda: util.append_data(prev_dir + '_append', last_file), repeat=1),
+            'read_data_files': timeit(read_data_files, repeat=1),
+            'read_data_store': timeit(lambda: util.read_data(store_dir=data_dir))
+            }
+    for key, value in results.items():
+        print('{:<32}{:>10.3f}'.format(key, value))
+    results.update(bench_combine(files_dir))
+    return results
+
+
+def bench_recovery(store_dir, gis_file=GIS_FILE):
+    """
+    Time the recovery table and map built at startup and on new data.
+    """
+    cube = WeeklyCube(store.read_store(store_dir))
+    geo_df = pd.read_csv(gis_file).set_index('STATION')
+    results = {
+        'recovery_frame': timeit(lambda: recovery_frame(cube, geo_df)),
+        'recovery_map': timeit(lambda: recovery_map(recovery_frame(cube, geo_df)))
+        }
+    for key, value in results.items():
+        print('{:<20}{:>10.3f}'.format(key, value))
+    return results
+
+
+def bench_encoding(store_dir, gis_file=GIS_FILE, sizes=(1, 50, None)):
+    """
+    Compare station names held as object strings against the integer station
+    ids: memory of the STATION column, size of the selection sent through
+    dcc.Store, and the time to filter the main frame and the recovery table.
+    """
+    df = store.read_store(store_dir)
+    cube = WeeklyCube(df)
+    df_meg = recovery_frame(cube, pd.read_csv(gis_file).set_index('STATION'))
+    names = df['STATION'].astype('object')
+    codes = df['STATION'].map(cube.station_index).to_numpy(dtype='int32')
+    results = {'station_object_megabytes': names.memory_usage(deep=True) / 2**20,
+               'station_id_megabytes': codes.nbytes / 2**20}
+    for size in sizes:
+        selected = cube.stations[:size]
+        ids = cube.station_ids(selected).tolist()
+        key = '_{}'.format(size or 'all')
+        results['store_bytes_names' + key] = len(json.dumps(selected))
+        results['store_bytes_ids' + key] = len(json.dumps(ids))
+        results['filter_frame_names' + key] = timeit(lambda: df[names.isin(selected)])
+        results['filter_frame_ids' + key] = timeit(lambda: df[cube.station_mask(ids)[codes]])
+        results['filter_table_names' + key] = timeit(lambda: df_meg[df_meg['STATION'].isin(selected)])
+        results['filter_table_ids' + key] = timeit(lambda: df_meg[cube.station_mask(ids)[df_meg['ID']]])
+    for key, value in results.items():
+        print('{:<32}{:>12.4f}'.format(key, value))
+    return results
+
+
+def process_memory(pid):
+    """
+    Returns the RSS and PSS of a process in megabytes (Linux only).
+    """
+    memory = {}
+    for file_name, field, key in [('status', 'VmRSS:', 'rss'), ('smaps_rollup', 'Pss:', 'pss')]:
+        with open('/proc/{}/{}'.format(pid, file_name)) as f:
+            for line in f:
+                if line.startswith(field):
+                    memory[key] = int(line.split()[1]) / 1024
+    return memory
+
+
+def child_pids(pid):
+    children = []
+    for name in os.listdir('/proc'):
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(name))
+        except (OSError, ValueError, IndexError):
+            pass
+    return children
+
+
+def bench_memory(data_dir, workers=(1, 4, 8), timeout=300):
+    """
+    Start gunicorn with each number of workers, with a private cube per
+    worker and no job pool, and with the cube memory-mapped from SHARED_DIR
+    by the workers and their job pool, and report the memory of the workers
+    and pool processes once they have loaded the data and computed Ranking
+    figures. The memory per worker includes its pool processes.
+    """
+    results = {}
+    print('{:<10}{:>8}{:>11}{:>14}{:>14}{:>14}'.format(
+        'mode', 'workers', 'processes', 'rss/worker', 'pss/worker', 'pss total'))
+    for num in workers:
+        for mode in ['private', 'shared']:
+            env = dict(os.environ, DATA_URL=data_dir.rstrip('/') + '/',
+                       CACHE_DIR=os.path.join(data_dir, 'cache'))
+            env.pop('SHARED_DIR', None)
+            if mode == 'shared':
+                env['SHARED_DIR'] = os.path.join(data_dir, 'shared')
+            else:
+                env['JOB_WORKERS'] = '0'
+            shutil.rmtree(env['CACHE_DIR'], ignore_errors=True)
+            port = free_port()
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            master = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '--workers', str(num), '--timeout', str(timeout),
+                 '--bind', '127.0.0.1:{}'.format(port), 'app:server'],
+                env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                deadline = time.time() + timeout
+                while time.time() < deadline:
+                    try:
+                        health = json.loads(http(base_url, '/health')[1])
+                        if health['ready']:
+                            break
+                    except (OSError, ValueError):
+                        pass
+                    time.sleep(0.1)
+                # Distinct figures, so that the pool processes of every worker load the cube.
+                callbacks = json.loads(http(base_url, '/_dash-dependencies')[1])
+                barplot = next(c for c in callbacks if 'bar_plot.figure' in c['output'])
+                for first in range(num * 4):
+                    figure_request(base_url, barplot, {'button_filtered': list(range(health['stations'])),
+                                                       'tabs': 'ranking',
+                                                       'ranking_range': [first, health['weeks'] - 1]})
+                stable, last, deadline = 0, None, time.time() + timeout
+                while stable < 3 and time.time() < deadline:
+                    time.sleep(1)
+                    pids = child_pids(master.pid)
+                    processes = pids + [pool_pid for pid in pids for pool_pid in child_pids(pid)]
+                    memory = []
+                    for pid in processes:
+                        try:
+                            memory.append(process_memory(pid))
+                        except OSError:
+                            pass
+                    total = sum(m['rss'] for m in memory)
+                    stable = stable + 1 if len(pids) == num and total == last else 0
+                    last = total
+            finally:
+                master.terminate()
+                master.wait()
+            key = '{}_{}'.format(mode, num)
+            results[key] = {
+                'processes': len(memory),
+                'rss_per_worker': sum(m['rss'] for m in memory) / num,
+                'pss_per_worker': sum(m['pss'] for m in memory) / num,
+                'pss_total': sum(m['pss'] for m in memory)
+                }
+            print('{:<10}{:>8}{:>11}{:>14.1f}{:>14.1f}{:>14.1f}'.format(mode, num, *results[key].values()))
+    return results
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.decode().strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], stdout=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip() != b''
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def save_results(benchmark, args, results, output=None):
+    """
+    Save the results of a run as JSON with the commit, the parameters and
+    the versions they were measured with.
+
+    Returns
+    -------
+    output : str
+        Path of the JSON file.
+    """
+    commit, dirty = git_commit()
+    if output is None:
+        output = os.path.join('benchmarks', '{}-{}-{:%Y%m%d%H%M%S}.json'.format(
+            benchmark, (commit or 'unknown')[:10], datetime.now()))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    record = {'benchmark': benchmark,
+              'commit': commit,
+              'dirty': dirty,
+              'time': '{:%Y-%m-%d %H:%M:%S}'.format(datetime.now()),
+              'parameters': {'weeks': args.weeks, 'stations': args.stations, 'csv': args.csv, 'seed': args.seed},
+              'versions': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__},
+              'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+              'results': results}
+    with open(output, 'w') as f:
+        json.dump(record, f, indent=2, default=float)
+    print('Results saved to', output)
+    return output
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old_file, new_file):
+    """
+    Print the results of two saved runs side by side with their ratio.
+    """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    for record in [old, new]:
+        print('{:<10}{}  {}'.format(record['benchmark'], (record['commit'] or 'unknown')[:10], record['parameters']))
+    old_results, new_results = flatten(old['results']), flatten(new['results'])
+    print('{:<40}{:>12}{:>12}{:>10}'.format('', 'old', 'new', 'new/old'))
+    for key in old_results:
+        if key in new_results:
+            ratio = new_results[key] / old_results[key] if old_results[key] else float('nan')
+            print('{:<40}{:>12.4f}{:>12.4f}{:>10.2f}'.format(key, old_results[key], new_results[key], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('benchmark', choices=['startup', 'boot', 'contention', 'callbacks', 'combine', 'recovery', 'memory',
+                                              'encoding', 'pipeline', 'suite', 'compare'])
+    parser.add_argument('files', nargs='*', help='two saved results to compare')
+    parser.add_argument('--weeks', type=int, default=300)
+    parser.add_argument('--stations', type=int, default=450)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help='existing main.csv to benchmark instead of synthetic data')
+    parser.add_argument('--output', help='JSON file of the results, by default under benchmarks/')
+    args = parser.parse_args()
+    if args.benchmark == 'compare':
+        compare(*args.files)
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.csv is None:
+            df = synthetic_frame(args.weeks, args.stations, args.seed)
+        else:
+            df = pd.read_csv(args.csv)
+        results = {}
+        if args.benchmark in ['combine', 'pipeline', 'suite']:
+            files_dir = os.path.join(tmp, 'files')
+            write_weekly_files(df, files_dir)
+            if args.benchmark == 'combine':
+                results = bench_combine(files_dir)
+            else:
+                results['pipeline'] = bench_pipeline(df, files_dir, tmp)
+        if args.benchmark not in ['combine', 'pipeline']:
+            csv_file = args.csv
+            if csv_file is None:
+                csv_file = os.path.join(tmp, 'main.csv')
+                df.to_csv(csv_file, index=False)
+            store_dir = os.path.join(tmp, 'store')
+            store.convert_csv(csv_file, store_dir)
+            gis_file = GIS_FILE
+            if os.path.exists(gis_file):
+                pd.read_csv(gis_file).to_csv(os.path.join(tmp, 'station_gis.csv'), index=False)
+            if args.benchmark == 'startup':
+                results = bench_startup(csv_file, store_dir)
+            elif args.benchmark == 'boot':
+                results = bench_boot(tmp)
+            elif args.benchmark == 'contention':
+                results = bench_contention(tmp)
+            elif args.benchmark == 'callbacks':
+                results = bench_callbacks(tmp)
+            elif args.benchmark == 'memory':
+                results = bench_memory(tmp)
+            elif args.benchmark == 'recovery':
+                results = bench_recovery(store_dir)
+            elif args.benchmark == 'encoding':
+                results = bench_encoding(store_dir)
+            elif args.benchmark == 'suite':
+                results['startup'] = bench_startup(csv_file, store_dir)
+                results['startup'].update(bench_app_startup(tmp))
+                results['boot'] = bench_boot(tmp)
+                results['recovery'] = bench_recovery(store_dir)
+                results['callbacks'] = bench_callbacks(tmp)
+    save_results(args.benchmark, args, results, args.output)
+
+
+if __name__ == '__main__':
+    main()
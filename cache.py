@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Bounded LRU cache of serialized figures, shared by the gunicorn workers
+through a local directory.
+
+Entries are keyed by the callback, the normalized station selection and the
+data version (latest WEEK). A new week changes the version, so stale figures
+are never served, and entries of older versions are purged on the next write.
+"""
+
+import os
+import json
+import hashlib
+import functools
+import plotly.utils
+from metrics import metrics
+
+
+class FigureCache:
+    """
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the entries, shared by all workers.
+    max_entries : int, optional
+        Number of entries kept, least recently used are evicted first.
+        The default is 256.
+    """
+
+    def __init__(self, cache_dir, max_entries=256):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, version, name, selected_station, *args):
+        """
+        Returns the file name of an entry. The station selection is
+        normalized so that its order and duplicates do not matter.
+        """
+        selection = sorted(set(str(station) for station in selected_station))
+        digest = hashlib.sha1(json.dumps([name, selection, args]).encode()).hexdigest()
+        return '{}-{}.json'.format(version, digest)
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path) as f:
+                text = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text
+
+    def set(self, key, text):
+        path = os.path.join(self.cache_dir, key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+        self._evict(key.rsplit('-', 1)[0])
+
+    def _evict(self, version):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.endswith('.json'):
+                continue
+            try:
+                # Versions are YYYY-MM-DD, workers still on an older week
+                # must not purge the entries of a newer one.
+                if name.rsplit('-', 1)[0] < version:
+                    os.remove(path)
+                else:
+                    entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {'pid': os.getpid(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len([name for name in os.listdir(self.cache_dir) if name.endswith('.json')]),
+                'max_entries': self.max_entries}
+
+    def memoize(self, version):
+        """
+        Decorator caching a figure callback whose first argument is the
+        station selection.
+
+        Parameters
+        ----------
+        version : callable
+            Returns the current data version.
+
+        Returns
+        -------
+        decorator : callable
+            The decorated callback returns the figure as a dict.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(selected_station, *args):
+                key = self.key(version(), func.__name__, selected_station or [], *args)
+                with metrics.phase('cache'):
+                    text = self.get(key)
+                if text is None:
+                    fig = func(selected_station, *args)
+                    with metrics.phase('serialize'):
+                        text = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+                    self.set(key, text)
+                metrics.payload(len(text))
+                return json.loads(text)
+            return wrapper
+        return decorator
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Weekly aggregate cube of the fare data.
+
+The swipes are summed over the REMOTEs of each station into a dense
+station x week x card type array, so that any station selection is answered
+by a vectorized sum over station rows instead of a groupby on the raw frame.
+"""
+
+import os
+import copy
+import json
+import numpy as np
+import pandas as pd
+import store
+
+FORMAT_VERSION = 2
+
+class WeeklyCube:
+    """
+    Attributes
+    ----------
+    stations : list
+        Station names, indexed by station id, in the order of the station
+        dictionary of the store when given.
+    weeks : pandas.DatetimeIndex
+        Sorted week ending dates, indexed by week id.
+    week_labels : list
+        Week ending dates as YYYY-MM-DD, indexed by week id.
+    card_types : list
+        Card types, indexed by card id, ordered by total swipes at build time.
+    counts : numpy.ndarray
+        Swipes per (station id, week id, card id).
+    totals : numpy.ndarray
+        Swipes per (station id, week id), summed over card types.
+    cum_totals : numpy.ndarray
+        Prefix sums of totals over the weeks, with a leading column of zeros:
+        cum_totals[:, w] is the total of the weeks before week id w.
+    all_counts : numpy.ndarray
+        Swipes per (week id, card id), summed over all stations.
+    """
+
+    def __init__(self, df, stations=None):
+        """
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            Normalized main data frame.
+        stations : list, optional
+            Station dictionary of the store, see store.extend_stations. The
+            default is None, the sorted stations of df.
+        """
+        cards = store.card_columns(df)
+        card_sums = df[cards].sum(axis=0).sort_values(ascending=False)
+        self.card_types = card_sums.index.tolist()
+        self.stations = []
+        self.station_index = {}
+        self._extend_stations(df['STATION'].unique(), stations)
+        self.weeks = pd.DatetimeIndex(sorted(df['WEEK'].unique()))
+        self.week_labels = self.weeks.strftime('%Y-%m-%d').tolist()
+        self.counts = self._aggregate(df, len(self.weeks), 0)
+        self._update_totals()
+
+    def _extend_stations(self, names, stations=None):
+        """
+        Give new ids to the stations of the dictionary and then to the other
+        names, sorted, that do not have one yet.
+        """
+        new_stations = [station for station in stations or [] if station not in self.station_index]
+        new_stations += sorted(set(names) - set(self.station_index) - set(new_stations))
+        for station in new_stations:
+            self.station_index[station] = len(self.stations)
+            self.stations.append(station)
+        return new_stations
+
+    def _aggregate(self, df, num_weeks, first_week):
+        """
+        Sum df into a station x week x card array covering num_weeks weeks
+        starting from week id first_week.
+        """
+        station_ids = df['STATION'].map(self.station_index).to_numpy(dtype='int64')
+        week_ids = self.weeks.get_indexer(df['WEEK']) - first_week
+        flat = station_ids * num_weeks + week_ids
+        size = len(self.stations) * num_weeks
+        counts = np.zeros((len(self.stations), num_weeks, len(self.card_types)), dtype='int32')
+        for card_id, card in enumerate(self.card_types):
+            if card in df.columns:
+                sums = np.bincount(flat, weights=df[card].to_numpy(), minlength=size)
+                counts[:, :, card_id] = sums.reshape(len(self.stations), num_weeks)
+        return counts
+
+    def _update_totals(self):
+        self.totals = self.counts.sum(axis=2, dtype='int64')
+        self.all_counts = self.counts.sum(axis=0, dtype='int64')
+        self.cum_totals = np.zeros((len(self.stations), len(self.weeks) + 1), dtype='int64')
+        np.cumsum(self.totals, axis=1, out=self.cum_totals[:, 1:])
+
+    def add_week(self, df_week, stations=None):
+        """
+        Append the data of one new WEEK to the cube. New stations and card
+        types get new ids at the end, existing ids are kept.
+
+        Parameters
+        ----------
+        df_week : pandas.DataFrame
+            Normalized data of a single WEEK later than the last week.
+        stations : list, optional
+            Station dictionary of the store. The default is None.
+        """
+        new_stations = self._extend_stations(df_week['STATION'].unique(), stations)
+        new_cards = [card for card in store.card_columns(df_week) if card not in self.card_types]
+        self.card_types += new_cards
+        self.counts = np.pad(self.counts, ((0, len(new_stations)), (0, 0), (0, len(new_cards))))
+        self.weeks = self.weeks.append(pd.DatetimeIndex([df_week['WEEK'].iloc[0]]))
+        self.week_labels = self.week_labels + ['{:%Y-%m-%d}'.format(self.weeks[-1])]
+        week = self._aggregate(df_week, 1, len(self.weeks) - 1)
+        self.counts = np.concatenate([self.counts, week], axis=1)
+        self._update_totals()
+
+    def copy(self):
+        """
+        Returns a copy that add_week can extend without changing this cube.
+        """
+        cube = copy.copy(self)
+        cube.stations = list(self.stations)
+        cube.station_index = dict(self.station_index)
+        cube.card_types = list(self.card_types)
+        return cube
+
+    def save(self, path):
+        """
+        Save the cube as a directory of .npy arrays and a meta.json, which
+        WeeklyCube.load can memory-map.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ['counts', 'totals', 'all_counts', 'cum_totals']:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        meta = {'stations': self.stations,
+                'weeks': self.week_labels,
+                'card_types': self.card_types}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Parameters
+        ----------
+        path : str
+            Directory written by WeeklyCube.save.
+        mmap_mode : str, optional
+            Passed to numpy.load. The default is 'r', read-only arrays backed
+            by the page cache and shared by every process mapping the files.
+
+        Returns
+        -------
+        cube : WeeklyCube
+        """
+        cube = cls.__new__(cls)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        cube.stations = meta['stations']
+        cube.station_index = {station: i for i, station in enumerate(cube.stations)}
+        cube.weeks = pd.DatetimeIndex(meta['weeks'])
+        cube.week_labels = meta['weeks']
+        cube.card_types = meta['card_types']
+        for name in ['counts', 'totals', 'all_counts', 'cum_totals']:
+            setattr(cube, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        return cube
+
+    def station_ids(self, stations):
+        """
+        Returns the sorted ids of the given station names, ignoring unknown names.
+        """
+        ids = [self.station_index[station] for station in stations if station in self.station_index]
+        return np.unique(np.array(ids, dtype='int64'))
+
+    def valid_ids(self, ids):
+        """
+        Returns the sorted unique ids among the given station ids, ignoring
+        ids unknown to the cube.
+        """
+        ids = np.unique(np.asarray(ids, dtype='int64'))
+        return ids[(ids >= 0) & (ids < len(self.stations))]
+
+    def station_mask(self, ids):
+        """
+        Returns a boolean mask over the station ids, True for the given ids.
+        """
+        mask = np.zeros(len(self.stations), dtype='bool')
+        mask[self.valid_ids(ids)] = True
+        return mask
+
+    def week_id(self, date):
+        """
+        Returns the id of the first week ending on or after date.
+        """
+        return int(self.weeks.searchsorted(pd.Timestamp(date)))
+
+    def range_totals(self, first_week, last_week, ids=None):
+        """
+        Returns the swipes per station summed over the weeks from first_week
+        to last_week included, in O(stations) from the prefix sums.
+        """
+        totals = self.cum_totals[:, last_week + 1] - self.cum_totals[:, first_week]
+        return totals if ids is None else totals[ids]
+
+    def card_totals(self, ids, first_week=0, last_week=None):
+        """
+        Returns the swipes per (week, card type) summed over the selected
+        stations, from first_week to last_week included (the last week when
+        None).
+        """
+        weeks = slice(first_week, None if last_week is None else last_week + 1)
+        if len(ids) == len(self.stations):
+            return self.all_counts[weeks]
+        return self.counts[ids, weeks].sum(axis=0, dtype='int64')
+
+    def top_stations(self, ids, week_ids, num):
+        """
+        Rank the selected stations in each of the given weeks with a partial
+        sort of the station x week totals.
+
+        Parameters
+        ----------
+        ids : numpy.ndarray
+            Selected station ids.
+        week_ids : numpy.ndarray
+            Week ids to rank.
+        num : int
+            Number of stations kept per week.
+
+        Returns
+        -------
+        top_ids : numpy.ndarray
+            Station ids per (rank, week), largest first.
+        swipes : numpy.ndarray
+            Swipes per (rank, week).
+        """
+        swipes = self.totals[np.ix_(ids, week_ids)]
+        num = min(num, len(ids))
+        if num == 0:
+            return np.empty((0, len(week_ids)), dtype='int64'), swipes
+        top = np.argpartition(-swipes, num - 1, axis=0)[:num]
+        values = np.take_along_axis(swipes, top, axis=0)
+        order = np.argsort(-values, axis=0, kind='stable')
+        top = np.take_along_axis(top, order, axis=0)
+        return ids[top], np.take_along_axis(values, order, axis=0)
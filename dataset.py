@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Data loaded by the dashboard, and the background reloader that picks up new
+weeks without restarting the workers.
+
+With a shared directory, the cube of each version is built by one worker and
+saved as .npy files that every worker memory-maps read-only, so the numeric
+data is held once per machine instead of once per gunicorn worker.
+
+A Dataset is never modified once built. The reloader builds the next one off
+the request path and swaps it in with a single assignment, so a callback that
+reads reloader.dataset once sees one consistent version throughout.
+
+The first dataset is also loaded in the background, so that importing the app
+is fast and a worker answers health and readiness probes while it loads.
+"""
+
+import os
+import time
+import shutil
+import threading
+import pandas as pd
+import store
+from cube import WeeklyCube, FORMAT_VERSION
+from recovery import recovery_frame, recovery_map, recovery_table
+from spatial import StationGrid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def build_cube(data_url, weeks, previous=None, stations=None):
+    """
+    Build the cube of the given weeks, only reading the later weeks when
+    previous covers a prefix of them. Station ids follow the station 
+    dictionary of the store when given.
+    """
+    if previous is not None and weeks[:len(previous.weeks)] == previous.weeks:
+        cube = previous.cube.copy()
+        new_weeks = weeks[len(previous.weeks):]
+        if new_weeks:
+            df = store.read_store(data_url + 'store', weeks=new_weeks)
+            for _, df_week in df.groupby('WEEK', sort=True):
+                cube.add_week(df_week, stations)
+        return cube
+    return WeeklyCube(store.read_store(data_url + 'store', weeks=weeks), stations)
+
+
+def shared_cube(shared_dir, weeks, build):
+    """
+    Memory-map the cube of the given weeks from shared_dir, calling build()
+    and saving its result first if no worker has done so yet.
+    """
+    path = os.path.join(shared_dir, 'cube-{}-{}-v{}'.format(weeks[-1], len(weeks), FORMAT_VERSION))
+    os.makedirs(shared_dir, exist_ok=True)
+    with open(os.path.join(shared_dir, 'lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            build().save(tmp)
+            os.rename(tmp, path)
+            for name in os.listdir(shared_dir):
+                if name.startswith('cube-') and name != os.path.basename(path):
+                    shutil.rmtree(os.path.join(shared_dir, name), ignore_errors=True)
+    return WeeklyCube.load(path)
+
+
+class DataNotReady(RuntimeError):
+    """
+    Raised when the first dataset is not loaded in time.
+    """
+
+
+class Dataset:
+    """
+    Attributes
+    ----------
+    version : str
+        Latest WEEK in the data as YYYY-MM-DD.
+    weeks : list
+        Weeks listed in the store manifest.
+    station_dictionary : list
+        Station dictionary of the store manifest, None for stores without one.
+    cube : cube.WeeklyCube
+        Weekly aggregate cube.
+    geo_df : pandas.DataFrame
+        Station GIS data indexed by STATION.
+    df_meg : pandas.DataFrame
+        Recovery per station, see recovery.recovery_frame.
+    table : dict
+        Columns of the data table, see recovery.recovery_table.
+    grid : spatial.StationGrid
+        Spatial index of the stations on the map.
+    fig : plotly.graph_objects.Figure
+        Recovery map.
+    load_seconds : float
+        Time taken to build the dataset.
+    """
+
+    def __init__(self, data_url, previous=None, shared_dir=None, cube_only=False):
+        """
+        Parameters
+        ----------
+        data_url : str
+            Local directory or URL holding store/ and station_gis.csv.
+        previous : Dataset, optional
+            Dataset of an older version. When the store only gained later
+            weeks, only those partitions are read and added to a copy of its
+            cube. The default is None.
+        shared_dir : str, optional
+            Directory, ideally on tmpfs such as /dev/shm, where the cube is 
+            shared between processes. The default is None, a private cube.
+        cube_only : boolean, optional
+            Only load the cube, all the figure jobs need, without the map,
+            table and grid. The default is False.
+        """
+        start = time.perf_counter()
+        manifest = store.ensure_store(data_url + 'store', data_url + 'main.csv')
+        if not manifest['weeks']:
+            raise FileNotFoundError('No weeks in {}store and no {}main.csv to convert'.format(data_url, data_url))
+        self.weeks = manifest['weeks']
+        self.station_dictionary = manifest.get('stations')
+        build = lambda: build_cube(data_url, self.weeks, previous, self.station_dictionary)
+        if shared_dir is None:
+            self.cube = build()
+        else:
+            self.cube = shared_cube(shared_dir, self.weeks, build)
+        self.version = '{:%Y-%m-%d}'.format(self.cube.weeks[-1])
+        self.load_seconds = time.perf_counter() - start
+        if cube_only:
+            return
+        if previous is not None:
+            self.geo_df = previous.geo_df
+        else:
+            self.geo_df = pd.read_csv(data_url + 'station_gis.csv').set_index('STATION')
+        self.df_meg = recovery_frame(self.cube, self.geo_df)
+        self.table = recovery_table(self.df_meg)
+        self.grid = StationGrid.from_geo(self.cube.stations, self.geo_df)
+        self.fig = recovery_map(self.df_meg)
+        self.load_seconds = time.perf_counter() - start
+
+    @property
+    def stations(self):
+        return self.cube.stations
+
+    @property
+    def card_types(self):
+        return self.cube.card_types
+
+    @property
+    def week_ending_cur(self):
+        return self.cube.weeks[-1]
+
+
+class Reloader:
+    """
+    Parameters
+    ----------
+    data_url : str
+        Local directory or URL holding store/ and station_gis.csv.
+    interval : float, optional
+        Seconds between checks of the store manifest. The default is 600.
+    shared_dir : str, optional
+        Directory where the cube is shared between processes. The default is
+        None, a private cube per process.
+    load_timeout : float, optional
+        Seconds a request waits for the first dataset before failing. The
+        default is 20.
+
+    The first dataset is loaded by the background thread started with
+    start(), or by load(), so that creating a Reloader is instantaneous.
+    """
+
+    def __init__(self, data_url, interval=600, shared_dir=None, load_timeout=20):
+        self.data_url = data_url
+        self.interval = interval
+        self.shared_dir = shared_dir
+        self.load_timeout = load_timeout
+        self.ready = threading.Event()
+        self.created_at = time.time()
+        self.loaded_at = None
+        self.checked_at = None
+        self.error = None
+        self._dataset = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def dataset(self):
+        """
+        The current dataset, waiting up to load_timeout for the first one.
+        """
+        if not self.ready.wait(self.load_timeout):
+            raise DataNotReady('Data not loaded yet' + (': ' + self.error if self.error else ''))
+        return self._dataset
+
+    def load(self):
+        """
+        Load the first dataset, unless already loaded.
+
+        Returns
+        -------
+        loaded : boolean
+            Signal whether a dataset is loaded.
+        """
+        with self._lock:
+            if self._dataset is None:
+                try:
+                    self._dataset = Dataset(self.data_url, shared_dir=self.shared_dir)
+                except Exception as e:
+                    self.error = repr(e)
+                    return False
+                self.error = None
+                self.loaded_at = self.checked_at = time.time()
+                self.ready.set()
+                print('Data loaded to version', self._dataset.version,
+                      'in {:.2f} seconds.'.format(self._dataset.load_seconds))
+            return True
+
+    def wait(self, timeout=None):
+        """
+        Wait for the first dataset, returns whether it is loaded.
+        """
+        return self.ready.wait(timeout)
+
+    def check(self):
+        """
+        Reload if the manifest lists other weeks than the current dataset.
+
+        Returns
+        -------
+        reloaded : boolean
+            Signal whether a new dataset was swapped in.
+        """
+        with self._lock:
+            current = self._dataset
+            if current is None:
+                return False
+            try:
+                weeks = store.read_manifest(self.data_url + 'store')['weeks']
+                self.checked_at = time.time()
+                if weeks == current.weeks:
+                    return False
+                dataset = Dataset(self.data_url, previous=current, shared_dir=self.shared_dir)
+            except Exception as e:
+                self.error = repr(e)
+                return False
+            self.error = None
+            self.loaded_at = time.time()
+            self._dataset = dataset
+            print('Data reloaded to version', dataset.version,
+                  'in {:.2f} seconds.'.format(dataset.load_seconds))
+            return True
+
+    def wake(self):
+        """
+        Have the background thread check the manifest now rather than at
+        the end of the interval, e.g. when newer data was seen elsewhere.
+        """
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self.load():
+            time.sleep(min(self.interval, 10))
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.check()
+
+    def health(self):
+        dataset = self._dataset
+        if dataset is None:
+            return {'ready': False,
+                    'waiting_seconds': time.time() - self.created_at,
+                    'error': self.error}
+        return {'ready': True,
+                'version': dataset.version,
+                'weeks': len(dataset.weeks),
+                'stations': len(dataset.stations),
+                'reload_seconds': dataset.load_seconds,
+                'loaded_at': self.loaded_at,
+                'checked_at': self.checked_at,
+                'error': self.error}
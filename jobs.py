@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Background pool computing the heavy figures off the gunicorn workers.
+
+A figure job is keyed like the figure cache. Submitting a job whose figure is
+cached returns it at once; otherwise a marker file is created next to the
+cache, with O_EXCL so that only one submitter runs it, and the job is sent
+to a local process pool. Identical selections submitted meanwhile, by any
+gunicorn worker, see the marker and wait for the same result instead of
+computing it again. The pool processes write the figure to the cache, where
+the polling callbacks pick it up.
+
+The pool is forked when the app module is imported, before the dataset is
+loaded and before the reloader thread starts. The pool processes only load
+the cube, memory-mapped from shared_dir so that it is held once with the
+gunicorn workers.
+"""
+
+import os
+import json
+import time
+import multiprocessing
+import plotly.utils
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cache import FigureCache
+from dataset import Dataset
+from metrics import metrics
+from ranking import START_DATE, ranking_frame, ranking_figure
+from trend import trend_figure
+
+
+def default_range(cube, week_range):
+    if week_range is None:
+        return [cube.week_id(START_DATE), len(cube.weeks) - 1]
+    return week_range
+
+
+def ranking_job(dataset, selected_station, week_range=None, max_frames=60):
+    """
+    Returns the ranking figure of the selected station ids, see ranking.py.
+    """
+    cube = dataset.cube
+    with metrics.phase('filter'):
+        ids = cube.valid_ids(selected_station)
+    with metrics.phase('aggregate'):
+        tmp = ranking_frame(cube, ids, *default_range(cube, week_range), max_frames)
+    with metrics.phase('figure'):
+        return ranking_figure(tmp)
+
+
+def trend_job(dataset, selected_station, week_range=None):
+    """
+    Returns the trend figure of the selected station ids, see trend.py.
+    """
+    cube = dataset.cube
+    with metrics.phase('filter'):
+        ids = cube.valid_ids(selected_station)
+    with metrics.phase('figure'):
+        return trend_figure(cube, ids, *default_range(cube, week_range))
+
+
+JOBS = {'create_barplot': ranking_job,
+        'create_areaplot': trend_job}
+
+
+def run(name, dataset, *args):
+    """
+    Compute the figure of a job in this process.
+    """
+    return JOBS[name](dataset, *args)
+
+
+_worker = {}
+
+
+def init_worker(data_url, cache_dir, max_entries, shared_dir=None):
+    """
+    Set up a pool process, its cube is loaded by its first job.
+    """
+    _worker.update(data_url=data_url, shared_dir=shared_dir, dataset=None,
+                   cache=FigureCache(cache_dir, max_entries))
+
+
+def worker_dataset(version):
+    """
+    Returns the dataset of the pool process, reloaded when older than the
+    version of the job. The store may have moved on meanwhile, so the
+    dataset can be newer than the job.
+    """
+    dataset = _worker['dataset']
+    if dataset is None or dataset.version < version:
+        dataset = Dataset(_worker['data_url'], previous=dataset, shared_dir=_worker['shared_dir'], cube_only=True)
+        _worker['dataset'] = dataset
+    return dataset
+
+
+def run_job(job_dir, key, name, version, args):
+    """
+    Compute a job in a pool process and write its figure to the cache, or
+    its error next to the marker. The figure is cached under the version of
+    the dataset it was computed with; when newer than the job, the newer
+    version is written next to the marker for the submitter to read it.
+
+    Returns
+    -------
+    seconds : float
+        Time taken by the job.
+    phases : dict
+        Milliseconds taken by each phase of the job, see metrics.phase.
+    """
+    start = time.perf_counter()
+    with metrics.collect() as phases:
+        try:
+            dataset = worker_dataset(version)
+            fig = run(name, dataset, *args)
+            with metrics.phase('serialize'):
+                text = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+            _worker['cache'].set(dataset.version + key[len(version):], text)
+            if dataset.version != version:
+                with open(os.path.join(job_dir, key + '.stale'), 'w') as f:
+                    f.write(dataset.version)
+        except Exception as e:
+            with open(os.path.join(job_dir, key + '.error'), 'w') as f:
+                f.write(repr(e))
+        finally:
+            try:
+                os.remove(os.path.join(job_dir, key + '.running'))
+            except OSError:
+                pass
+    return time.perf_counter() - start, phases
+
+
+class JobPool:
+    """
+    Parameters
+    ----------
+    cache : cache.FigureCache
+        Cache where the figures are written and read.
+    data_url : str
+        Local directory or URL holding store/ and station_gis.csv.
+    workers : int, optional
+        Number of pool processes, 0 to compute the jobs in the calling
+        thread. The default is 1.
+    shared_dir : str, optional
+        Directory where the pool processes memory-map the cube, the same as
+        the dataset of the caller. The default is None, a private cube per
+        pool process.
+    timeout : float, optional
+        Seconds after which a job still marked running is considered lost
+        and submitted again. The default is 120.
+    wait : float, optional
+        Seconds the submitter waits for its job before handing it over to
+        polling, so that quick figures are returned in the same request.
+        The default is 0.1.
+    """
+
+    def __init__(self, cache, data_url, workers=1, shared_dir=None, timeout=120, wait=0.1):
+        self.cache = cache
+        self.data_url = data_url
+        self.workers = workers
+        self.shared_dir = shared_dir
+        self.timeout = timeout
+        self.wait = wait
+        self.job_dir = os.path.join(cache.cache_dir, 'jobs')
+        self.submitted = 0
+        self.coalesced = 0
+        self.failed = 0
+        self._executor = None
+        os.makedirs(self.job_dir, exist_ok=True)
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('fork'), initializer=init_worker,
+                initargs=(self.data_url, self.cache.cache_dir, self.cache.max_entries, self.shared_dir))
+        return self._executor
+
+    def start(self):
+        """
+        Fork the pool processes now, to be called before starting any thread
+        in the process. Otherwise they are forked on the first job, or after
+        a pool process died.
+        """
+        if self.workers:
+            # The processes are only forked on the first submission.
+            self.executor().submit(os.getpid).result()
+
+    def _claim(self, key):
+        """
+        Create the running marker of a job, returns False if a live job
+        already holds it.
+        """
+        path = os.path.join(self.job_dir, key + '.running')
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < self.timeout:
+                        return False
+                    os.remove(path)
+                except OSError:
+                    pass
+        return False
+
+    def _pop(self, key, suffix):
+        path = os.path.join(self.job_dir, key + suffix)
+        try:
+            with open(path) as f:
+                text = f.read()
+            os.remove(path)
+        except OSError:
+            return None
+        return text
+
+    def submit(self, key, name, version, args, dataset=None, poll=False):
+        """
+        Parameters
+        ----------
+        key : str
+            Cache key of the figure.
+        name : str
+            Job name, see JOBS.
+        version : str
+            Data version of the job.
+        args : list
+            Arguments of the job function after the dataset.
+        dataset : dataset.Dataset, optional
+            Dataset of the caller, used to compute the job in the calling
+            thread.
+        poll : boolean, optional
+            Signal that the caller already submitted the job and checks on
+            it, not counted as coalesced. The default is False.
+
+        Returns
+        -------
+        status : str
+            'done', 'running', 'failed' or 'stale' when the job was computed
+            with newer data than the version, and cached under that version.
+        result : str
+            Serialized figure when done, error when failed, newer version
+            when stale, None otherwise.
+        """
+        with metrics.phase('cache'):
+            text = self.cache.get(key)
+        if text is not None:
+            return 'done', text
+        error = self._pop(key, '.error')
+        if error is not None:
+            self.failed += 1
+            return 'failed', error
+        newer = self._pop(key, '.stale')
+        if newer is not None:
+            return 'stale', newer
+        if not self._claim(key):
+            self.coalesced += not poll
+            return self._join(key)
+        self.submitted += 1
+        if self.workers == 0:
+            try:
+                fig = run(name, dataset, *args)
+                with metrics.phase('serialize'):
+                    text = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+                self.cache.set(key, text)
+            finally:
+                os.remove(os.path.join(self.job_dir, key + '.running'))
+            return 'done', text
+        future = self.executor().submit(run_job, self.job_dir, key, name, version, list(args))
+        future.add_done_callback(lambda future: self._done(key, name, future))
+        try:
+            future.result(self.wait)
+        except Exception:
+            return 'running', None
+        return self.submit(key, name, version, args, dataset, True)
+
+    def _join(self, key):
+        """
+        Wait up to self.wait for a job submitted by another caller.
+        """
+        marker = os.path.join(self.job_dir, key + '.running')
+        deadline = time.time() + self.wait
+        while os.path.exists(marker) and time.time() < deadline:
+            time.sleep(0.01)
+        text = self.cache.get(key)
+        if text is not None:
+            return 'done', text
+        return 'running', None
+
+    def _done(self, key, name, future):
+        error = future.exception()
+        if error is None:
+            # The phases were timed in the pool process, recorded here under the callback.
+            seconds, phases = future.result()
+            metrics.observe(name, 'job', seconds * 1000)
+            for phase, milliseconds in phases.items():
+                metrics.observe(name, phase, milliseconds)
+            return
+        # The pool process died before clearing the marker.
+        if isinstance(error, BrokenProcessPool):
+            self._executor = None
+        with open(os.path.join(self.job_dir, key + '.error'), 'w') as f:
+            f.write(repr(error))
+        try:
+            os.remove(os.path.join(self.job_dir, key + '.running'))
+        except OSError:
+            pass
+
+    def stats(self):
+        names = os.listdir(self.job_dir)
+        return {'pid': os.getpid(),
+                'workers': self.workers,
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+                'running': len([name for name in names if name.endswith('.running')])}
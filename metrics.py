@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Latency metrics of the Dash callbacks.
+
+Each instrumented callback records its total time, the time of its phases
+(filter, aggregate, figure, serialize) and its payload size into fixed-bucket
+histograms kept per worker process. The phases of a figure computed on the
+job pool are collected in the pool process and recorded by the worker under
+the callback. A sampled fraction of the calls can be profiled with cProfile.
+
+With a shared directory, every worker writes its histograms there once per
+flush interval, and a snapshot merges the histograms of all live workers, so
+that any worker answers for the whole server.
+"""
+
+import os
+import json
+import time
+import tempfile
+import random
+import cProfile
+import functools
+import threading
+import contextlib
+import plotly.utils
+
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+BUCKETS_BYTES = [1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7]
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def state(self):
+        return {'buckets': self.buckets, 'counts': self.counts, 'count': self.count,
+                'total': self.total, 'max': self.max}
+
+    def merge(self, state):
+        self.counts = [a + b for a, b in zip(self.counts, state['counts'])]
+        self.count += state['count']
+        self.total += state['total']
+        self.max = max(self.max, state['max'])
+
+    def snapshot(self):
+        labels = ['<={:g}'.format(bucket) for bucket in self.buckets] + ['>{:g}'.format(self.buckets[-1])]
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'buckets': dict(zip(labels, self.counts))}
+
+
+class Metrics:
+    """
+    Parameters
+    ----------
+    profile_rate : float, optional
+        Fraction of the callback calls profiled with cProfile. The default
+        is 0, no profiling.
+    profile_dir : str, optional
+        Directory where the .prof files are written. The default is None.
+    shared_dir : str, optional
+        Directory where the workers share their histograms, see share(). The
+        default is None, histograms of this process only.
+    flush_interval : float, optional
+        Seconds between the writes of the histograms to shared_dir. The
+        default is 1.
+    """
+
+    def __init__(self, profile_rate=0.0, profile_dir=None, shared_dir=None, flush_interval=1.0):
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.shared_dir = shared_dir
+        self.flush_interval = flush_interval
+        self.histograms = {}
+        self.profiles = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._dirty = threading.Event()
+        self._thread = None
+
+    def share(self, shared_dir):
+        """
+        Share the histograms of this process through shared_dir.
+        """
+        os.makedirs(shared_dir, exist_ok=True)
+        self.shared_dir = shared_dir
+
+    def observe(self, callback, name, value, buckets=BUCKETS_MS):
+        with self._lock:
+            key = (callback, name)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+            if self.shared_dir is not None:
+                self._dirty.set()
+                # Started on the first observation, in the gunicorn worker.
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+            self.flush()
+            time.sleep(self.flush_interval)
+
+    def flush(self):
+        """
+        Write the histograms and profiles of this process to shared_dir.
+        """
+        with self._lock:
+            state = {'histograms': [[callback, name, histogram.state()]
+                                    for (callback, name), histogram in self.histograms.items()],
+                     'profiles': list(self.profiles)}
+        path = os.path.join(self.shared_dir, '{}.json'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the instrumented callback running in this thread, or
+        add it to the phases collected by collect(). Otherwise nothing is
+        recorded.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            callback = getattr(self._local, 'callback', None)
+            phases = getattr(self._local, 'phases', None)
+            if callback is not None:
+                self.observe(callback, name, elapsed)
+            elif phases is not None:
+                phases[name] = phases.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def collect(self):
+        """
+        Collect the phases timed in this thread outside of a callback, e.g.
+        by a job in a pool process, as a dict of milliseconds by phase for
+        the process of the callback to observe.
+        """
+        phases = {}
+        self._local.phases = phases
+        try:
+            yield phases
+        finally:
+            self._local.phases = None
+
+    def payload(self, size):
+        """
+        Record the size in bytes of the serialized output of the running callback.
+        """
+        callback = getattr(self._local, 'callback', None)
+        if callback is not None:
+            self._local.payload = True
+            self.observe(callback, 'payload_bytes', size, BUCKETS_BYTES)
+
+    def instrument(self, func):
+        """
+        Decorator recording the total time, phases and payload of a callback.
+        Callbacks that do not report their payload through payload() are
+        serialized once to measure it.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self._local.callback = func.__name__
+            self._local.payload = False
+            profiler = None
+            if self.profile_rate > 0 and random.random() < self.profile_rate:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                if not self._local.payload:
+                    with self.phase('serialize'):
+                        size = len(json.dumps(result, cls=plotly.utils.PlotlyJSONEncoder))
+                    self.payload(size)
+                return result
+            finally:
+                self.observe(func.__name__, 'total', (time.perf_counter() - start) * 1000)
+                self._local.callback = None
+                if profiler is not None:
+                    profiler.disable()
+                    self._dump(func.__name__, profiler)
+        return wrapper
+
+    def _dump(self, callback, profiler):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, '{}-{}-{:.0f}.prof'.format(
+            callback, os.getpid(), time.time() * 1000))
+        profiler.dump_stats(path)
+        with self._lock:
+            self.profiles = (self.profiles + [path])[-100:]
+
+    def _shared_states(self):
+        """
+        Returns the states written by the live workers, by pid, removing the
+        files of the workers that exited.
+        """
+        self.flush()
+        states = {}
+        for name in os.listdir(self.shared_dir):
+            if not name.endswith('.json'):
+                continue
+            pid, path = int(name[:-5]), os.path.join(self.shared_dir, name)
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path) as f:
+                    states[pid] = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return states
+
+    def snapshot(self):
+        """
+        Returns the histograms of this process, merged with those of the
+        other workers when shared.
+        """
+        if self.shared_dir is None:
+            with self._lock:
+                histograms = dict(self.histograms)
+                profiles = list(self.profiles)
+            pids = [os.getpid()]
+        else:
+            histograms, profiles = {}, []
+            states = self._shared_states()
+            for state in states.values():
+                for callback, name, histogram in state['histograms']:
+                    if (callback, name) not in histograms:
+                        histograms[callback, name] = Histogram(histogram['buckets'])
+                    histograms[callback, name].merge(histogram)
+                profiles += state['profiles']
+            pids = sorted(states)
+        callbacks = {}
+        for (callback, name), histogram in sorted(histograms.items()):
+            callbacks.setdefault(callback, {})[name] = histogram.snapshot()
+        return {'pid': os.getpid(),
+                'workers': pids,
+                'callbacks': callbacks,
+                'profile_rate': self.profile_rate,
+                'profiles': profiles}
+
+
+metrics = Metrics(float(os.environ.get('PROFILE_RATE', 0)),
+                  os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'metrocard-profiles')))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Ranking of the stations by average daily swipes, animated over the weeks.
+
+Shared by the Ranking tab of the dashboard and the offline reports. The
+figure is emitted as a plain dict with one frame per week, the same figure
+as Plotly Express builds for an animated bar chart, without validating every
+frame.
+"""
+
+import numpy as np
+import pandas as pd
+from trend import TEMPLATE, COLORWAY
+
+START_DATE = '2020-01-04'
+HOVERTEMPLATE = ('Station: %{customdata[0]} <br>' +
+                 'Week Ending: %{customdata[1]} <br>' +
+                 'Swipes: %{customdata[2]:,}<extra></extra>')
+ANIMATE_PLAY = {'frame': {'duration': 500, 'redraw': True}, 'mode': 'immediate',
+                'fromcurrent': True, 'transition': {'duration': 500, 'easing': 'linear'}}
+ANIMATE_STEP = {'frame': {'duration': 0, 'redraw': True}, 'mode': 'immediate',
+                'fromcurrent': True, 'transition': {'duration': 0, 'easing': 'linear'}}
+
+
+def ranking_frame(cube, ids, first_week, last_week, max_frames=60, num_bars=15):
+    """
+    Parameters
+    ----------
+    cube : cube.WeeklyCube
+        Weekly aggregate cube.
+    ids : numpy.ndarray
+        Selected station ids.
+    first_week : int
+        Id of the first week ranked.
+    last_week : int
+        Id of the last week ranked.
+    max_frames : int, optional
+        Maximum number of weeks ranked, evenly spaced and ending at last_week.
+        The default is 60.
+    num_bars : int, optional
+        Number of stations ranked per week. The default is 15.
+
+    Returns
+    -------
+    tmp : pandas.DataFrame
+        WEEK, STATION and swipes of the top stations of each week ranked,
+        largest first.
+    """
+    stride = -(-(last_week - first_week + 1) // max_frames)
+    week_ids = np.arange(last_week, first_week - 1, -stride)[::-1]
+    top_ids, swipes = cube.top_stations(ids, week_ids, num_bars)
+    return pd.DataFrame({
+        'WEEK': np.repeat(cube.weeks[week_ids].strftime('%Y-%m-%d'), top_ids.shape[0]),
+        'STATION': np.array(cube.stations, dtype='object')[top_ids.T.ravel()],
+        'swipes': (swipes.T.ravel() / 7).astype('int')
+        })
+
+
+def ranking_figure(tmp):
+    """
+    Parameters
+    ----------
+    tmp : pandas.DataFrame
+        Ranking frame, see ranking_frame.
+
+    Returns
+    -------
+    fig : dict
+        Horizontal bar chart of the ranking with one animation frame per week.
+    """
+    weeks, stations, swipes = (tmp[column].to_numpy() for column in ('WEEK', 'STATION', 'swipes'))
+    starts = np.flatnonzero(np.r_[True, weeks[1:] != weeks[:-1]]) if len(tmp) else []
+    frames = []
+    for start, end in zip(starts, list(starts[1:]) + [len(tmp)]):
+        x, y = swipes[start:end].tolist(), stations[start:end].tolist()
+        frames.append({'name': weeks[start], 'data': [{
+            'type': 'bar', 'orientation': 'h', 'name': '', 'showlegend': False,
+            'marker': {'color': COLORWAY[0]}, 'x': x, 'y': y,
+            'customdata': [[station, weeks[start], value] for station, value in zip(y, x)],
+            'hovertemplate': HOVERTEMPLATE}]})
+    steps = [{'args': [[frame['name']], ANIMATE_STEP], 'label': frame['name'], 'method': 'animate'}
+             for frame in frames]
+    layout = {'template': TEMPLATE,
+              'xaxis': {'title': {'text': 'Average Daily MetroCard Swipes'},
+                        'range': [0, int(tmp['swipes'].max()) if len(tmp) else 1]},
+              'yaxis': {'title': {'text': 'Station Name'}, 'autorange': 'reversed'},
+              'margin': {'r': 0, 't': 0, 'l': 0, 'b': 0},
+              'updatemenus': [{
+                  'type': 'buttons', 'direction': 'left', 'showactive': False,
+                  'pad': {'r': 10, 't': 70}, 'x': 0.1, 'xanchor': 'right', 'y': 0, 'yanchor': 'top',
+                  'buttons': [{'args': [None, ANIMATE_PLAY], 'label': '&#9654;', 'method': 'animate'},
+                              {'args': [[None], ANIMATE_STEP], 'label': '&#9724;', 'method': 'animate'}]}],
+              'sliders': [{
+                  'active': 0, 'currentvalue': {'prefix': 'Week Ending='}, 'len': 0.9,
+                  'pad': {'b': 10, 't': 60}, 'x': 0.1, 'xanchor': 'left', 'y': 0, 'yanchor': 'top',
+                  'steps': steps}]}
+    return {'data': frames[0]['data'] if frames else [], 'layout': layout, 'frames': frames}
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Pandemic recovery per station: the recent week against the same week of the
+pre-pandemic year, and the recovery map built from it.
+"""
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+BASELINE_YEAR = 2019
+
+
+def baseline_week_id(cube, week_id, baseline_year=BASELINE_YEAR):
+    """
+    Parameters
+    ----------
+    cube : cube.WeeklyCube
+        Weekly aggregate cube.
+    week_id : int
+        Id of the recent week.
+    baseline_year : int, optional
+        Pre-pandemic year. The default is 2019.
+
+    Returns
+    -------
+    week_id : int
+        Id of the week of baseline_year closest to the same calendar date,
+        None if the cube does not cover that date.
+    """
+    week = cube.weeks[week_id]
+    target = week - pd.DateOffset(years=week.year - baseline_year)
+    nearest = cube.weeks.get_indexer([target], method='nearest')[0]
+    if abs(cube.weeks[nearest] - target) > pd.Timedelta(days=3):
+        return None
+    return int(nearest)
+
+
+def format_counts(values):
+    return pd.Series(values.astype('int64')).map('{:,}'.format).to_numpy()
+
+
+def baseline_range(cube, week_range, baseline_year=BASELINE_YEAR):
+    """
+    Returns the weeks of baseline_year corresponding to the weeks of
+    week_range as (first week id, last week id), None if the cube does not
+    cover them.
+    """
+    first, last = [baseline_week_id(cube, week_id, baseline_year) for week_id in week_range]
+    if first is None or last is None:
+        return None
+    return first, last
+
+
+def recovery_frame(cube, geo_df, week_range=None, baseline=None):
+    """
+    Parameters
+    ----------
+    cube : cube.WeeklyCube
+        Weekly aggregate cube.
+    geo_df : pandas.DataFrame
+        Station GIS data (lat, lon, wiki) indexed by STATION.
+    week_range : tuple, optional
+        Ids of the first and last recent weeks. The default is None, the 
+        latest week.
+    baseline : tuple, optional
+        Ids of the first and last pre-pandemic weeks. The default is None, 
+        the same weeks of BASELINE_YEAR.
+
+    Returns
+    -------
+    df_meg : pandas.DataFrame
+        One row per station with swipes in the recent weeks: the station id,
+        the totals over the weeks (row_sum_x recent, row_sum_y pre-pandemic),
+        the recovery ratio of the weekly averages, the formatted average 
+        daily swipes, the GIS data and the map marker size.
+    """
+    if week_range is None:
+        week_range = (len(cube.weeks) - 1, len(cube.weeks) - 1)
+    if baseline is None:
+        baseline = baseline_range(cube, week_range)
+    cur = cube.range_totals(*week_range)
+    old = np.zeros_like(cur) if baseline is None else cube.range_totals(*baseline)
+    ids = np.flatnonzero(cur > 0)
+    cur, old = cur[ids], old[ids]
+    cur_days = 7 * (week_range[1] - week_range[0] + 1)
+    old_days = 7 * (1 if baseline is None else baseline[1] - baseline[0] + 1)
+    cur_daily, old_daily = cur / cur_days, old / old_days
+    df_meg = pd.DataFrame({
+        'ID': ids,
+        'STATION': np.array(cube.stations, dtype='object')[ids],
+        'row_sum_x': cur,
+        'row_sum_y': old,
+        'ratio': np.round(np.divide(cur_daily, old_daily, out=np.zeros(len(ids)), where=old > 0), 4),
+        'Recent Daily': format_counts(cur_daily),
+        'Pre-pandemic Daily': format_counts(old_daily)
+        })
+    geo = geo_df.reindex(df_meg['STATION'])
+    for column in geo.columns:
+        df_meg[column] = geo[column].to_numpy()
+    df_meg['size'] = cur_daily
+    return df_meg
+
+
+def recovery_table(df_meg):
+    """
+    Parameters
+    ----------
+    df_meg : pandas.DataFrame
+        Output of recovery_frame.
+
+    Returns
+    -------
+    table : dict
+        Columns of the data table as lists, keyed by the table column names, 
+        with the station ids under ID.
+    """
+    return {'ID': df_meg['ID'].tolist(),
+            'Station': df_meg['STATION'].tolist(),
+            'Recent Daily': df_meg['Recent Daily'].tolist(),
+            'Pre-pandemic Daily': df_meg['Pre-pandemic Daily'].tolist(),
+            'Recovery Ratio': df_meg['ratio'].tolist(),
+            'lat': df_meg['lat'].round(decimals=5).tolist(),
+            'lon': df_meg['lon'].round(decimals=5).tolist()}
+
+
+def recovery_map(df_meg):
+    """
+    Parameters
+    ----------
+    df_meg : pandas.DataFrame
+        Output of recovery_frame.
+
+    Returns
+    -------
+    fig : plotly.graph_objects.Figure
+        Recovery map of the stations.
+    """
+    fig = px.scatter_mapbox(
+        df_meg, lat="lat", lon="lon", size='size', color='ratio', zoom=10,
+        labels={'ratio':'% Recovery'},
+        custom_data=['STATION', 'Pre-pandemic Daily', 'Recent Daily', 'ratio'],
+        range_color=[0, df_meg['ratio'].quantile(0.75)],
+        color_continuous_scale=px.colors.sequential.Blues
+        )
+    fig.update_layout(
+        mapbox_style="carto-positron",
+        margin={"r":0,"t":0,"l":0,"b":0},
+        coloraxis={'colorbar':{'len':0.5, 'x':0, 'tickformat':'.0%', 'yanchor':'top'}}
+        )
+    fig.update_traces(
+        hovertemplate=
+            '<b>Station: %{customdata[0]}</b> <br>' +
+            'Recent Average Daily: %{customdata[2]} <br>' +
+            'Pre-pandemic Daily: %{customdata[1]} <br>' +
+            '% Recovery : %{customdata[3]:.2%}'
+        )
+    return fig
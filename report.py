@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Offline export of the weekly reports of station groups.
+
+Each report holds the ranking and trend figures of a group of stations, and
+its ranking, trend and recovery tables as CSV, computed by the same functions
+as the dashboard callbacks. The reports are fanned out across a process pool
+whose workers each load the dataset once, at start up.
+
+Usage:
+    python report.py groups.json --output reports/ --processes 4
+
+The groups file maps group names to station names, either as JSON
+{group: [station, ...]} or as a CSV with GROUP and STATION columns. A report
+for ALL STATIONS is always written. Each report is written to a directory
+named after its group, see summary.json for the directory of each group.
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import pandas as pd
+import plotly.io as pio
+from concurrent.futures import ProcessPoolExecutor
+from dataset import Dataset
+from ranking import START_DATE, ranking_frame, ranking_figure
+from recovery import recovery_table
+from trend import trend_figure, trend_frame
+
+ALL_STATIONS = 'ALL STATIONS'
+
+_dataset = None
+
+
+def init_worker(data_url, shared_dir=None):
+    """
+    Load the dataset of the worker process, once for all its reports.
+    """
+    global _dataset
+    _dataset = Dataset(data_url, shared_dir=shared_dir)
+
+
+def read_groups(path):
+    """
+    Parameters
+    ----------
+    path : str
+        JSON file mapping group names to lists of station names, or CSV file
+        with GROUP and STATION columns.
+
+    Returns
+    -------
+    groups : dict
+        Station names by group name.
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            return {str(name): list(stations) for name, stations in json.load(f).items()}
+    df = pd.read_csv(path, usecols=['GROUP', 'STATION'], dtype=str)
+    return {name: df_group['STATION'].tolist() for name, df_group in df.groupby('GROUP', sort=False)}
+
+
+def slug(name):
+    return re.sub(r'[^A-Za-z0-9]+', '-', name).strip('-').lower() or 'group'
+
+
+def report_dirs(names):
+    """
+    Returns a distinct directory name per group name, names with the same
+    slug, e.g. 'Mid-Town' and 'Mid Town', being suffixed -2, -3, ... in order.
+    """
+    dirs, used = [], set()
+    for name in names:
+        base = candidate = slug(name)
+        suffix = 1
+        while candidate in used:
+            suffix += 1
+            candidate = '{}-{}'.format(base, suffix)
+        used.add(candidate)
+        dirs.append(candidate)
+    return dirs
+
+
+def write_figure(fig, path, figure_format):
+    if figure_format == 'html':
+        pio.write_html(fig, path + '.html', include_plotlyjs='cdn', validate=False)
+    else:
+        pio.write_json(fig, path + '.json', validate=False)
+
+
+def write_report(name, stations, output_dir, report_dir=None, week_range=None, figure_format='html',
+                 max_frames=60):
+    """
+    Write the report of one group with the dataset of the worker.
+
+    Parameters
+    ----------
+    name : str
+        Name of the group.
+    stations : list
+        Station names of the group, None for all stations.
+    output_dir : str
+        Directory where the report directory of the group is created.
+    report_dir : str, optional
+        Name of the report directory. The default is None, the slug of the
+        group name.
+    week_range : list, optional
+        Ids of the first and last week of the ranking and trend. The default
+        is None, from START_DATE to the latest week.
+    figure_format : str, optional
+        'html' or 'json'. The default is 'html'.
+    max_frames : int, optional
+        Maximum number of weeks ranked. The default is 60.
+
+    Returns
+    -------
+    result : dict
+        Name, directory, number of stations and seconds taken by the report.
+    """
+    start = time.perf_counter()
+    dataset = _dataset
+    cube = dataset.cube
+    if stations is None:
+        ids = cube.valid_ids(range(len(cube.stations)))
+    else:
+        ids = cube.station_ids(stations)
+    if week_range is None:
+        week_range = [cube.week_id(START_DATE), len(cube.weeks) - 1]
+    path = os.path.join(output_dir, report_dir or slug(name))
+    os.makedirs(path, exist_ok=True)
+    if len(ids):
+        tmp = ranking_frame(cube, ids, *week_range, max_frames)
+        tmp.to_csv(os.path.join(path, 'ranking.csv'), index=False)
+        write_figure(ranking_figure(tmp), os.path.join(path, 'ranking'), figure_format)
+        trend_frame(cube, ids, *week_range).to_csv(os.path.join(path, 'trend.csv'))
+        write_figure(trend_figure(cube, ids, *week_range), os.path.join(path, 'trend'), figure_format)
+    df_meg = dataset.df_meg[dataset.df_meg['ID'].isin(ids)]
+    pd.DataFrame(recovery_table(df_meg)).drop(columns='ID').to_csv(
+        os.path.join(path, 'recovery.csv'), index=False)
+    return {'name': name, 'path': path, 'stations': len(ids),
+            'seconds': time.perf_counter() - start}
+
+
+def _write_report(task):
+    name, stations, kwargs = task
+    return write_report(name, stations, **kwargs)
+
+
+def write_reports(data_url, groups, output_dir, processes=None, shared_dir=None, **kwargs):
+    """
+    Write the reports of all groups and of ALL STATIONS across a process pool.
+
+    Parameters
+    ----------
+    data_url : str
+        Local directory or URL holding store/ and station_gis.csv.
+    groups : dict
+        Station names by group name.
+    output_dir : str
+        Directory of the reports.
+    processes : int, optional
+        Number of worker processes, 0 to write the reports in this process.
+        The default is None, one per CPU.
+    shared_dir : str, optional
+        Directory where the workers share the cube. The default is None, a
+        private cube per worker.
+    **kwargs
+        Passed to write_report.
+
+    Returns
+    -------
+    summary : dict
+        Reports written, seconds taken and throughput in reports per second,
+        overall and excluding the dataset loading.
+    """
+    start = time.perf_counter()
+    kwargs = dict(kwargs, output_dir=output_dir)
+    groups = [(ALL_STATIONS, None)] + list(groups.items())
+    dirs = report_dirs([name for name, _ in groups])
+    tasks = [(name, stations, dict(kwargs, report_dir=report_dir))
+             for (name, stations), report_dir in zip(groups, dirs)]
+    if processes == 0:
+        workers = 1
+        init_worker(data_url, shared_dir)
+        results = list(map(_write_report, tasks))
+    else:
+        workers = processes or os.cpu_count()
+        chunksize = max(1, len(tasks) // (4 * workers))
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(data_url, shared_dir)) as pool:
+            results = list(pool.map(_write_report, tasks, chunksize=chunksize))
+    seconds = time.perf_counter() - start
+    report_seconds = sum(result['seconds'] for result in results)
+    summary = {'reports': len(results),
+               'processes': workers,
+               'seconds': seconds,
+               'reports_per_second': len(results) / seconds,
+               'reports_per_second_loaded': len(results) * workers / report_seconds if report_seconds else 0.0,
+               'results': results}
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the weekly reports of station groups.')
+    parser.add_argument('groups', nargs='?', help='JSON or CSV file of the station groups')
+    parser.add_argument('--data', default=os.environ.get('DATA_URL', 'data/'),
+                        help='directory or URL holding store/ and station_gis.csv')
+    parser.add_argument('--output', default='reports', help='directory of the reports')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, 0 to run in this process (default: one per CPU)')
+    parser.add_argument('--shared-dir', default=os.environ.get('SHARED_DIR'),
+                        help='directory where the workers share the cube')
+    parser.add_argument('--format', choices=['html', 'json'], default='html', help='format of the figures')
+    parser.add_argument('--frames', type=int, default=int(os.environ.get('RANKING_FRAMES', 60)),
+                        help='maximum number of weeks ranked')
+    args = parser.parse_args()
+    groups = read_groups(args.groups) if args.groups else {}
+    os.makedirs(args.output, exist_ok=True)
+    summary = write_reports(args.data, groups, args.output, args.processes, args.shared_dir,
+                            figure_format=args.format, max_frames=args.frames)
+    print('Wrote {} reports with {} processes in {:.2f} seconds: {:.2f} reports/s '
+          '({:.2f} reports/s once loaded).'.format(
+              summary['reports'], summary['processes'], summary['seconds'],
+              summary['reports_per_second'], summary['reports_per_second_loaded']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Spatial index of the stations on the recovery map.
+
+The stations are bucketed in a uniform lat/lon grid, so that a box or lasso
+selection on the map is resolved to station ids on the server from the
+selection outline alone, instead of the browser sending back every selected
+point.
+"""
+
+import numpy as np
+
+
+class StationGrid:
+    """
+    Parameters
+    ----------
+    ids : numpy.ndarray
+        Station ids.
+    lon : numpy.ndarray
+        Longitude of the stations. Stations without coordinates are skipped.
+    lat : numpy.ndarray
+        Latitude of the stations.
+    cell : float, optional
+        Size of the grid cells in degrees. The default is 0.01, about 1 km.
+    """
+
+    def __init__(self, ids, lon, lat, cell=0.01):
+        ids, lon, lat = np.asarray(ids), np.asarray(lon, dtype='float64'), np.asarray(lat, dtype='float64')
+        mapped = np.isfinite(lon) & np.isfinite(lat)
+        self.ids, self.lon, self.lat = ids[mapped], lon[mapped], lat[mapped]
+        self.cell = cell
+        self.origin = (self.lon.min(), self.lat.min()) if len(self.ids) else (0.0, 0.0)
+        cells = self._cells(self.lon, self.lat)
+        self.shape = tuple(cells.max(axis=1) + 1) if len(self.ids) else (0, 0)
+        keys = cells[0] * max(self.shape[1], 1) + cells[1]
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    @classmethod
+    def from_geo(cls, stations, geo_df, cell=0.01):
+        """
+        Index every station of the cube with coordinates in geo_df, whatever
+        the weeks it has swipes in, so that one grid serves all week ranges.
+        """
+        geo_df = geo_df.reindex(stations)
+        return cls(np.arange(len(stations)), geo_df['lon'].to_numpy(), geo_df['lat'].to_numpy(), cell)
+
+    def _cells(self, lon, lat):
+        return np.floor(np.array([np.asarray(lon) - self.origin[0],
+                                  np.asarray(lat) - self.origin[1]]) / self.cell).astype('int64')
+
+    def candidates(self, lon_min, lon_max, lat_min, lat_max):
+        """
+        Returns the positions of the stations in the grid cells overlapping
+        the bounding box.
+        """
+        if len(self.ids) == 0:
+            return np.empty(0, dtype='int64')
+        (x0, x1), (y0, y1) = self._cells([lon_min, lon_max], [lat_min, lat_max])
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.shape[0] - 1), min(y1, self.shape[1] - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype='int64')
+        columns = np.arange(x0, x1 + 1) * self.shape[1]
+        starts = np.searchsorted(self.keys, columns + y0, side='left')
+        ends = np.searchsorted(self.keys, columns + y1, side='right')
+        return np.concatenate([self.order[start:end] for start, end in zip(starts, ends)])
+
+    def box(self, corners):
+        """
+        Returns the sorted ids of the stations inside the box given by two
+        opposite [lon, lat] corners.
+        """
+        (lon0, lat0), (lon1, lat1) = corners
+        lon_min, lon_max, lat_min, lat_max = min(lon0, lon1), max(lon0, lon1), min(lat0, lat1), max(lat0, lat1)
+        found = self.candidates(lon_min, lon_max, lat_min, lat_max)
+        inside = ((self.lon[found] >= lon_min) & (self.lon[found] <= lon_max) &
+                  (self.lat[found] >= lat_min) & (self.lat[found] <= lat_max))
+        return np.sort(self.ids[found[inside]])
+
+    def lasso(self, points):
+        """
+        Returns the sorted ids of the stations inside the polygon given by
+        its [lon, lat] vertices, by ray casting.
+        """
+        points = np.asarray(points, dtype='float64')
+        if len(points) < 3:
+            return np.empty(0, dtype=self.ids.dtype)
+        found = self.candidates(points[:, 0].min(), points[:, 0].max(), points[:, 1].min(), points[:, 1].max())
+        x, y = self.lon[found], self.lat[found]
+        inside = np.zeros(len(found), dtype='bool')
+        for (x0, y0), (x1, y1) in zip(points, np.roll(points, -1, axis=0)):
+            crosses = (y0 > y) != (y1 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= crosses & (x < x_cross)
+        return np.sort(self.ids[found[inside]])
+
+    def select(self, selection):
+        """
+        Parameters
+        ----------
+        selection : dict
+            {'range': corners} of a box selection or {'lasso': vertices} of a
+            lasso selection on the map, in [lon, lat].
+
+        Returns
+        -------
+        ids : numpy.ndarray
+            Sorted ids of the selected stations, None without selection.
+        """
+        if not selection:
+            return None
+        if selection.get('range'):
+            return self.box(selection['range'])
+        if selection.get('lasso'):
+            return self.lasso(selection['lasso'])
+        return None
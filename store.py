@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Columnar on-disk store for the weekly fare data.
+
+Each WEEK is kept as its own Parquet partition (YYYY-MM-DD.parquet) next to a
+small manifest.json listing the weeks present. The manifest lets the app read
+the store from a plain HTTP location (e.g. raw GitHub), where directories
+cannot be listed.
+
+The manifest also holds the station dictionary: every station name in the
+order it was first seen, sorted within a batch of weeks. A station's position
+in the dictionary is its integer id, which never changes as weeks are added,
+so ids are the same in every process and across reloads.
+"""
+
+import os
+import sys
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MANIFEST = 'manifest.json'
+ID_COLUMNS = ['REMOTE', 'STATION']
+COMPRESSION = 'zstd'
+
+
+def is_url(path):
+    return path.startswith('http://') or path.startswith('https://')
+
+
+def join(store_dir, name):
+    """
+    Join a file name onto a store location, which may be a URL.
+    """
+    if is_url(store_dir):
+        return store_dir.rstrip('/') + '/' + name
+    return os.path.join(store_dir, name)
+
+
+def partition_name(week):
+    return '{:%Y-%m-%d}.parquet'.format(pd.Timestamp(week))
+
+
+def card_columns(df):
+    return [column for column in df.columns if column not in ID_COLUMNS + ['WEEK']]
+
+
+def normalize_frame(df):
+    """
+    Convert a main data frame to the compact in-memory layout.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data frame with REMOTE, STATION, WEEK and one column per card type.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        WEEK as datetime64, REMOTE and STATION as categoricals and card type
+        counts downcast to the smallest integer dtype.
+    """
+    df = df.copy()
+    df['WEEK'] = pd.to_datetime(df['WEEK'], format='%Y-%m-%d')
+    for column in ID_COLUMNS:
+        df[column] = df[column].astype('category')
+    for column in card_columns(df):
+        df[column] = pd.to_numeric(df[column].fillna(0), downcast='integer')
+    return df
+
+
+def read_manifest(store_dir):
+    """
+    Parameters
+    ----------
+    store_dir : str
+        Local directory or URL of the store.
+
+    Returns
+    -------
+    manifest : dict
+        {'weeks': [...]} with the weeks sorted as YYYY-MM-DD strings. Empty
+        when the store does not exist yet.
+    """
+    path = join(store_dir, MANIFEST)
+    if is_url(path):
+        with urlopen(path) as f:
+            return json.load(f)
+    if not os.path.exists(path):
+        return {'weeks': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def extend_stations(manifest, names):
+    """
+    Append the given station names missing from the station dictionary of
+    the manifest, sorted. Stores whose manifest predates the dictionary are
+    left without one unless they are empty.
+    """
+    if 'stations' not in manifest and manifest['weeks']:
+        return manifest
+    stations = manifest.get('stations', [])
+    manifest['stations'] = stations + sorted(set(names) - set(stations))
+    return manifest
+
+
+def write_manifest(manifest, store_dir):
+    manifest['weeks'] = sorted(set(manifest['weeks']))
+    path = join(store_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def partition_schema(df_week):
+    """
+    Schema of a partition: REMOTE and STATION dictionary encoded and card type
+    counts as int32, so that all partitions and all chunks of a partition
+    share one schema whatever the dtypes of the frame they come from.
+    """
+    schema = pa.Schema.from_pandas(df_week, preserve_index=False)
+    for column in df_week.columns:
+        if column in ID_COLUMNS:
+            field = pa.field(column, pa.dictionary(pa.int32(), pa.string()))
+        elif column != 'WEEK':
+            field = pa.field(column, pa.int32())
+        else:
+            continue
+        schema = schema.set(schema.get_field_index(column), field)
+    return schema
+
+
+def write_chunks(chunks, week, store_dir):
+    """
+    Stream the chunks of one WEEK into its partition, one row group per
+    chunk, so that only one chunk is held in memory at a time.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Normalized data frames of the WEEK with the same columns.
+    week : str
+        WEEK of the chunks.
+    store_dir : str
+        Directory of the store.
+
+    Returns
+    -------
+    path : str
+        Path of the written partition.
+    """
+    path = join(store_dir, partition_name(week))
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                writer = pq.ParquetWriter(path + '.tmp', partition_schema(chunk), compression=COMPRESSION)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError('No data for week ' + week)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def write_partition(df_week, store_dir):
+    """
+    Card type counts are written as int32 so that all partitions share one
+    schema; they are downcast again when read.
+
+    Parameters
+    ----------
+    df_week : pandas.DataFrame
+        Normalized data of a single WEEK.
+    store_dir : str
+        Directory of the store.
+
+    Returns
+    -------
+    path : str
+        Path of the written partition.
+    """
+    return write_chunks([df_week], '{:%Y-%m-%d}'.format(df_week['WEEK'].iloc[0]), store_dir)
+
+
+def append_chunks(chunks, week, store_dir):
+    """
+    Add one week to the store from its chunks unless the manifest already
+    lists it, in which case the chunks are not consumed. The cost only
+    depends on the size of the week.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Normalized data frames of the WEEK, e.g. a generator parsing the file.
+    week : str
+        WEEK of the chunks as YYYY-MM-DD.
+    store_dir : str
+        Directory of the store.
+
+    Returns
+    -------
+    written : list
+        Paths of the partition and manifest written, empty when the week is
+        already in the store.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = read_manifest(store_dir)
+    if week in manifest['weeks']:
+        return []
+    names = set()
+
+    def collect(chunks):
+        for chunk in chunks:
+            names.update(chunk['STATION'].unique())
+            yield chunk
+
+    written = [write_chunks(collect(chunks), week, store_dir)]
+    extend_stations(manifest, names)
+    manifest['weeks'].append(week)
+    written.append(write_manifest(manifest, store_dir))
+    return written
+
+
+def append_partition(df_week, store_dir):
+    """
+    Add one week to the store unless the manifest already lists it.
+
+    Parameters
+    ----------
+    df_week : pandas.DataFrame
+        Normalized data of a single WEEK.
+    store_dir : str
+        Directory of the store.
+
+    Returns
+    -------
+    written : list
+        Paths of the partition and manifest written, empty when the week is
+        already in the store.
+    """
+    return append_chunks([df_week], '{:%Y-%m-%d}'.format(df_week['WEEK'].iloc[0]), store_dir)
+
+
+def write_store(df, store_dir):
+    """
+    Write a main data frame as one partition per WEEK. Partitions already
+    listed in the manifest are immutable and are not rewritten.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Main data frame.
+    store_dir : str
+        Directory of the store.
+
+    Returns
+    -------
+    written : list
+        Paths of the partitions and manifest written.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    df = normalize_frame(df)
+    manifest = read_manifest(store_dir)
+    written, weeks, names = [], [], set()
+    for week, df_week in df.groupby('WEEK', sort=True):
+        week = '{:%Y-%m-%d}'.format(week)
+        if week in manifest['weeks']:
+            continue
+        written.append(write_partition(df_week, store_dir))
+        weeks.append(week)
+        names.update(df_week['STATION'].unique())
+    extend_stations(manifest, names)
+    manifest['weeks'] += weeks
+    written.append(write_manifest(manifest, store_dir))
+    return written
+
+
+def read_partition(path):
+    if is_url(path):
+        with urlopen(path) as f:
+            path = BytesIO(f.read())
+    return pq.read_table(path, use_threads=False, read_dictionary=ID_COLUMNS)
+
+
+def unify_tables(tables):
+    """
+    Cast the partitions to one schema: card types missing from a week become
+    nulls and integer columns take the widest width used.
+    """
+    schemas = []
+    for table in tables:
+        if not any(table.schema.equals(schema, check_metadata=False) for schema in schemas):
+            schemas.append(table.schema)
+    if len(schemas) <= 1:
+        return tables
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            current = fields.get(field.name)
+            if current is None or (pa.types.is_integer(field.type) and 
+                                   pa.types.is_integer(current.type) and
+                                   field.type.bit_width > current.type.bit_width):
+                fields[field.name] = field
+    schema = pa.schema(list(fields.values()))
+    unified = []
+    for table in tables:
+        if not table.schema.equals(schema, check_metadata=False):
+            names = set(table.column_names)
+            for field in schema:
+                if field.name not in names:
+                    table = table.append_column(field, pa.nulls(len(table), field.type))
+            table = table.select(schema.names).cast(schema)
+        unified.append(table)
+    return unified
+
+
+def read_store(store_dir, max_workers=8, weeks=None):
+    """
+    Parameters
+    ----------
+    store_dir : str
+        Local directory or URL of the store.
+    max_workers : int, optional
+        Number of partitions read concurrently. The default is 8.
+    weeks : list, optional
+        Weeks to read as YYYY-MM-DD strings. The default is None, all weeks
+        listed in the manifest.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Normalized main data frame.
+    """
+    if weeks is None:
+        weeks = read_manifest(store_dir)['weeks']
+    paths = [join(store_dir, partition_name(week)) for week in weeks]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(read_partition, paths))
+    df = pa.concat_tables(unify_tables(tables)).to_pandas()
+    for column in ID_COLUMNS:
+        df[column] = df[column].astype('category')
+    for column in card_columns(df):
+        df[column] = pd.to_numeric(df[column].fillna(0), downcast='integer')
+    return df
+
+
+def convert_csv(csv_file, store_dir):
+    """
+    One-shot conversion of an existing main.csv into the columnar store.
+
+    Parameters
+    ----------
+    csv_file : str
+        Path or URL of main.csv.
+    store_dir : str
+        Directory of the store.
+
+    Returns
+    -------
+    written : list
+        Paths of the partitions and manifest written.
+    """
+    return write_store(pd.read_csv(csv_file), store_dir)
+
+
+
+def ensure_store(store_dir, csv_file):
+    """
+    Convert csv_file into a local store that has no weeks yet, as left by
+    deployments that predate the store. Processes starting together convert
+    it once.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory or URL of the store.
+    csv_file : str
+        Path of main.csv.
+
+    Returns
+    -------
+    manifest : dict
+        Manifest of the store, without weeks when there was nothing to convert.
+    """
+    manifest = read_manifest(store_dir)
+    if manifest['weeks'] or is_url(store_dir) or not os.path.exists(csv_file):
+        return manifest
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, 'lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if not read_manifest(store_dir)['weeks']:
+            print('Converting', csv_file, 'to', store_dir + '.')
+            convert_csv(csv_file, store_dir)
+    return read_manifest(store_dir)
+
+
+if __name__ == '__main__':
+    csv_file = sys.argv[1] if len(sys.argv) > 1 else 'data/main.csv'
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else 'data/store'
+    written = convert_csv(csv_file, store_dir)
+    print('Wrote', len(written) - 1, 'partitions to', store_dir + '.')
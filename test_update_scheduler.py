@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Test of the weekly update against local MTA files and a local git repository.
+"""
+
+import os
+import subprocess
+import pandas as pd
+import pytest
+import store
+from datetime import datetime
+from update_scheduler import Publisher, LocalGitPublisher, update
+
+
+def write_raw(path, rows):
+    with open(path, 'w') as f:
+        f.write('Fare Type Data\nFrom: x To: y\nREMOTE,STATION,FF,SEN/DIS,     \n')
+        for remote, station, ff, sen in rows:
+            f.write('{},{:<20},{:05d},{:05d},\n'.format(remote, station, ff, sen))
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    for variable in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv('GIT_{}_NAME'.format(variable), 'test')
+        monkeypatch.setenv('GIT_{}_EMAIL'.format(variable), 'test@example.com')
+    repo_dir = tmp_path / 'repo'
+    store_dir = repo_dir / 'data' / 'store'
+    store_dir.mkdir(parents=True)
+    df = pd.DataFrame({'REMOTE': ['R001', 'R002'], 'STATION': ['WHITEHALL STREET', 'BROAD STREET'],
+                       'WEEK': ['2021-01-02'] * 2, 'FF': [10, 20], 'SEN/DIS': [1, 2]})
+    store.write_store(store.normalize_frame(df), str(store_dir))
+    subprocess.run(['git', 'init', '-q', str(repo_dir)], check=True)
+    subprocess.run(['git', '-C', str(repo_dir), 'add', '.'], check=True)
+    subprocess.run(['git', '-C', str(repo_dir), 'commit', '-q', '-m', 'baseline'], check=True)
+    fares_dir = tmp_path / 'fares'
+    fares_dir.mkdir()
+    write_raw(fares_dir / 'fares_210116.csv', [('R001', 'WHITEHALL STREET', 12, 3), ('R002', 'BROAD STREET', 21, 2)])
+    write_raw(fares_dir / 'fares_210123.csv', [('R001', 'WHITEHALL STREET', 14, 4)])
+    return repo_dir, fares_dir
+
+
+def git(repo_dir, *args):
+    return subprocess.run(['git', '-C', str(repo_dir)] + list(args), check=True,
+                          stdout=subprocess.PIPE).stdout.decode().strip()
+
+
+def test_publisher_is_abstract():
+    with pytest.raises(TypeError):
+        Publisher()
+
+
+def test_update_commits_new_weeks(repo):
+    repo_dir, fares_dir = repo
+    data_url = str(repo_dir / 'data') + os.sep
+    publisher = LocalGitPublisher(str(repo_dir))
+    weeks = update(data_url, publisher, today=datetime(2021, 1, 30), base_url=str(fares_dir) + os.sep)
+    assert weeks == ['2021-01-09', '2021-01-16']
+    assert git(repo_dir, 'rev-list', '--count', 'HEAD') == '2'
+    assert sorted(git(repo_dir, 'show', '--name-only', '--format=', 'HEAD').split()) == [
+        'data/store/2021-01-09.parquet', 'data/store/2021-01-16.parquet', 'data/store/manifest.json']
+    assert git(repo_dir, 'status', '--porcelain') == ''
+    df = store.read_store(data_url + 'store')
+    assert sorted(df['WEEK'].dt.strftime('%Y-%m-%d').unique()) == ['2021-01-02', '2021-01-09', '2021-01-16']
+    assert df.loc[df['WEEK'] == '2021-01-16', 'FF'].tolist() == [14]
+
+
+def test_update_stops_at_missing_week(repo):
+    repo_dir, fares_dir = repo
+    data_url = str(repo_dir / 'data') + os.sep
+    os.remove(fares_dir / 'fares_210116.csv')
+    weeks = update(data_url, LocalGitPublisher(str(repo_dir)), today=datetime(2021, 1, 30),
+                   base_url=str(fares_dir) + os.sep)
+    assert weeks == []
+    assert git(repo_dir, 'rev-list', '--count', 'HEAD') == '1'
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Test of the downloader against a local HTTP stand-in serving fixture files.
+"""
+
+import os
+import threading
+import pytest
+import pandas as pd
+import utilities as util
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RAW = ('Fare Type Data\nFrom: x To: y\nREMOTE,STATION,FF,SEN/DIS,     \n'
+       'R001,WHITEHALL STREET    ,{:05d},00003,\n')
+
+
+class FaresServer(ThreadingHTTPServer):
+    """
+    Serves files by path, answering 'failures' with the status listed for
+    the path before serving it, and counts the requests per path.
+    """
+
+    def __init__(self, files, failures=None):
+        super().__init__(('127.0.0.1', 0), FaresHandler)
+        self.files = files
+        self.failures = failures or {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+
+class FaresHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.lstrip('/')
+        with self.server.lock:
+            self.server.requests[path] += 1
+            failures = self.server.failures.get(path, [])
+            status = failures.pop(0) if failures else None
+        if status is None and path not in self.server.files:
+            status = 404
+        if status is not None:
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.files[path].encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(files, failures=None):
+        server = FaresServer(files, failures)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_files(serve, tmp_path):
+    server = serve({'fares_210109.csv': RAW.format(12), 'fares_210116.csv': RAW.format(14)})
+    summary = util.download_files('210109', 3, str(tmp_path), base_url=server.url, retries=2, backoff=0)
+    assert summary['downloaded'] == ['210102.csv', '210109.csv']
+    assert summary['skipped'] == []
+    assert list(summary['failed']) == ['fares_210123.csv']
+    assert '404' in summary['failed']['fares_210123.csv']
+    assert server.requests['fares_210123.csv'] == 1
+    df = pd.read_csv(tmp_path / '210109.csv')
+    assert df.columns.tolist() == ['REMOTE', 'STATION', 'FF', 'SEN/DIS']
+    assert df['FF'].tolist() == [14]
+
+    summary = util.download_files('210109', 2, str(tmp_path), base_url=server.url, retries=2, backoff=0)
+    assert summary['downloaded'] == []
+    assert summary['skipped'] == ['210102.csv', '210109.csv']
+    assert server.requests['fares_210109.csv'] == 1
+
+
+def test_download_resumes_from_raw(serve, tmp_path):
+    server = serve({})
+    os.makedirs(tmp_path / 'raw')
+    with open(tmp_path / 'raw' / 'fares_210109.csv', 'w') as f:
+        f.write(RAW.format(12))
+    summary = util.download_files('210109', 1, str(tmp_path), base_url=server.url, retries=2, backoff=0)
+    assert summary['downloaded'] == ['210102.csv']
+    assert server.requests['fares_210109.csv'] == 0
+
+
+def test_download_retries_server_errors(serve, tmp_path):
+    server = serve({'fares_210109.csv': RAW.format(12), 'fares_210116.csv': RAW.format(14)},
+                   {'fares_210109.csv': [503, 500], 'fares_210116.csv': [503, 503, 503]})
+    summary = util.download_files('210109', 2, str(tmp_path), base_url=server.url, retries=2, backoff=0)
+    assert summary['downloaded'] == ['210102.csv']
+    assert server.requests['fares_210109.csv'] == 3
+    assert list(summary['failed']) == ['fares_210116.csv']
+    assert '503' in summary['failed']['fares_210116.csv']
+    assert server.requests['fares_210116.csv'] == 3
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+@author: junyan
+
+Trend of the MetroCard types over the weeks for a selection of stations.
+
+The figure is emitted as a plain dict with one stacked area trace per card
+type, taken directly from the week x card type sums of the cube, instead of
+melting a long frame for Plotly Express.
+"""
+
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+
+TEMPLATE = pio.templates['seaborn'].to_plotly_json()
+COLORWAY = TEMPLATE['layout']['colorway']
+HOVERTEMPLATE = ('<b>MetroCard Type: %{fullData.name}</b> <br>' +
+                 'MetroCard Swipes: %{y:,} <br>' +
+                 'Week Ending: %{x}<extra></extra>')
+
+
+def trend_figure(cube, ids, first_week=0, last_week=None):
+    """
+    Parameters
+    ----------
+    cube : cube.WeeklyCube
+        Weekly aggregate cube.
+    ids : numpy.ndarray
+        Selected station ids.
+    first_week : int, optional
+        Id of the first week shown. The default is 0.
+    last_week : int, optional
+        Id of the last week shown. The default is None, the latest week.
+
+    Returns
+    -------
+    fig : dict
+        Stacked area figure of the average daily swipes per card type, the
+        card types ordered by their mean over the weeks shown, largest first.
+    """
+    totals = cube.card_totals(ids, first_week, last_week)
+    order = np.argsort(-totals.sum(axis=0), kind='stable')
+    swipes = (totals / 7).astype('int64')
+    weeks = cube.week_labels[first_week:None if last_week is None else last_week + 1]
+    data = []
+    for i, card_id in enumerate(order):
+        card = cube.card_types[card_id]
+        data.append({'type': 'scatter', 'mode': 'lines', 'stackgroup': '1',
+                     'name': card, 'legendgroup': card, 'showlegend': True,
+                     'line': {'color': COLORWAY[i % len(COLORWAY)]},
+                     'x': weeks, 'y': swipes[:, card_id],
+                     'hovertemplate': HOVERTEMPLATE})
+    layout = {'template': TEMPLATE,
+              'xaxis': {'title': {'text': 'Date'}, 'spikemode': 'across', 'spikethickness': 1},
+              'yaxis': {'title': {'text': 'Average Daily MetroCard Swipes'}},
+              'legend': {'title': {'text': 'MetroCard Type'}, 'tracegroupgap': 0},
+              'margin': {'r': 0, 't': 0, 'l': 0, 'b': 0}}
+    return {'data': data, 'layout': layout}
+
+
+def trend_frame(cube, ids, first_week=0, last_week=None):
+    """
+    Returns the average daily swipes per card type of the selected stations
+    as a frame indexed by week ending, one column per card type.
+    """
+    totals = cube.card_totals(ids, first_week, last_week)
+    weeks = cube.week_labels[first_week:None if last_week is None else last_week + 1]
+    return pd.DataFrame((totals / 7).astype('int64'), columns=list(cube.card_types),
+                        index=pd.Index(weeks, name='WEEK'))
@@ -2,47 +2,182 @@
 """
 @author: junyan
 
-Scheduler to update the data/main.csv every week.
+Scheduler to update the data/store every week.
+
+Every week posted by the MTA since the last week of the store is appended as
+its own compressed partition, and only those partitions and the updated
+manifest are committed, in a single commit, through a Publisher: the GitHub
+repository of the app, or a local git repository.
 """
 
 import os
 import sys
-import pandas as pd
+import abc
+import base64
+import shutil
+import tempfile
+import subprocess
+import store
 import utilities as util
-from github import Github, InputGitTreeElement
 from datetime import timedelta, datetime
 
-if 'DATA_URL' in os.environ: 	
-    data_url = os.environ['DATA_URL']
-    token = os.environ['GITHUB_TOKEN']
-else:
-    data_url = 'data/'  
-
-df = pd.read_csv(data_url + 'main.csv')
-last_date = datetime.strptime(df['WEEK'].max(), '%Y-%m-%d')
-new_date = last_date + timedelta(days=7)
-file_date = new_date + timedelta(days=7)
-file_name = 'fares_{:%y%m%d}.csv'.format(file_date)
-new_data_url = 'http://web.mta.info/developers/data/nyct/fares/' + file_name
-
-try:
-    df, new_data_added = util.add_data(df, new_data_url)
-except:
-    print('Unexpected error:', sys.exc_info()[0])
-    print('The data link generated is: ', new_data_url)
-    new_data_added = False
-
-if new_data_added:
-    df = df.to_csv(sep=',', index=False)
-    commit_message = "Data Updated - " + datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    g = Github(token)
-    repo = g.get_user().get_repo('metrocard-visualization')
-    master_ref = repo.get_git_ref("heads/master")
-    master_sha = master_ref.object.sha
-    base_tree = repo.get_git_tree(master_sha)
-    element = InputGitTreeElement('data/main.csv', '100644', 'blob', df)
-    tree = repo.create_git_tree([element], base_tree)
-    parent = repo.get_git_commit(master_sha)
-    commit = repo.create_git_commit(commit_message, tree, [parent])
-    master_ref.edit(commit.sha)
-    print(commit_message)
\ No newline at end of file
+
+class Publisher(abc.ABC):
+    """
+    Commits files of the store to a repository.
+    """
+
+    @abc.abstractmethod
+    def publish(self, paths, message):
+        """
+        Parameters
+        ----------
+        paths : list
+            Local paths of the files to commit under the store directory.
+        message : str
+            Commit message.
+
+        Returns
+        -------
+        sha : str
+            Sha of the new commit.
+        """
+
+
+class GithubPublisher(Publisher):
+    """
+    Parameters
+    ----------
+    token : str
+        GitHub access token.
+    repo_name : str, optional
+        Repository of the app. The default is 'metrocard-visualization'.
+    branch : str, optional
+        Branch to commit to. The default is 'master'.
+    store_path : str, optional
+        Path of the store in the repository. The default is 'data/store/'.
+    """
+
+    def __init__(self, token, repo_name='metrocard-visualization', branch='master', store_path='data/store/'):
+        self.token = token
+        self.repo_name = repo_name
+        self.branch = branch
+        self.store_path = store_path
+
+    def publish(self, paths, message):
+        from github import Github, InputGitTreeElement
+        g = Github(self.token)
+        repo = g.get_user().get_repo(self.repo_name)
+        master_ref = repo.get_git_ref('heads/' + self.branch)
+        master_sha = master_ref.object.sha
+        base_tree = repo.get_git_tree(master_sha)
+        elements = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                content = base64.b64encode(f.read()).decode()
+            blob = repo.create_git_blob(content, 'base64')
+            element = InputGitTreeElement(self.store_path + os.path.basename(path), '100644', 'blob', sha=blob.sha)
+            elements.append(element)
+        tree = repo.create_git_tree(elements, base_tree)
+        parent = repo.get_git_commit(master_sha)
+        commit = repo.create_git_commit(message, tree, [parent])
+        master_ref.edit(commit.sha)
+        return commit.sha
+
+
+class LocalGitPublisher(Publisher):
+    """
+    Stand-in for GithubPublisher committing to a local git repository.
+
+    Parameters
+    ----------
+    repo_dir : str
+        Work tree of the repository.
+    store_path : str, optional
+        Path of the store in the repository. The default is 'data/store/'.
+    """
+
+    def __init__(self, repo_dir, store_path='data/store/'):
+        self.repo_dir = repo_dir
+        self.store_path = store_path
+
+    def git(self, *args):
+        return subprocess.run(['git', '-C', self.repo_dir] + list(args), check=True,
+                              stdout=subprocess.PIPE).stdout.decode().strip()
+
+    def publish(self, paths, message):
+        store_dir = os.path.join(self.repo_dir, self.store_path)
+        os.makedirs(store_dir, exist_ok=True)
+        names = []
+        for path in paths:
+            name = os.path.join(self.store_path, os.path.basename(path))
+            if os.path.abspath(path) != os.path.abspath(os.path.join(self.repo_dir, name)):
+                shutil.copyfile(path, os.path.join(self.repo_dir, name))
+            names.append(name)
+        self.git('add', '--', *names)
+        self.git('commit', '-q', '-m', message, '--', *names)
+        return self.git('rev-parse', 'HEAD')
+
+
+def update(data_url, publisher, today=None, base_url=util.MTA_FARES_URL):
+    """
+    Append every week posted since the last week of the store and publish
+    the new partitions and manifest in one commit. Stops at the first week
+    whose file cannot be read, which is retried on the next run. A manifest
+    without station dictionary gets one from the stations of the store.
+
+    Parameters
+    ----------
+    data_url : str
+        Local directory or URL holding store/.
+    publisher : Publisher
+        Where the new files are committed.
+    today : datetime, optional
+        Date of the run. The default is None, now.
+    base_url : str, optional
+        Location of the fares_YYMMDD.csv files as posted by the MTA. The
+        default is MTA_FARES_URL.
+
+    Returns
+    -------
+    weeks : list
+        Weeks added, as YYYY-MM-DD.
+    """
+    today = today or datetime.now()
+    manifest = store.ensure_store(data_url + 'store', data_url + 'main.csv')
+    if not manifest['weeks']:
+        raise FileNotFoundError('No weeks in {}store and no {}main.csv to convert'.format(data_url, data_url))
+    if 'stations' not in manifest:
+        stations = store.read_store(data_url + 'store')['STATION'].unique().tolist()
+        manifest['stations'] = sorted(stations)
+    last_date = datetime.strptime(manifest['weeks'][-1], '%Y-%m-%d')
+    weeks, written = [], set()
+    with tempfile.TemporaryDirectory() as tmp:
+        store.write_manifest(manifest, tmp)
+        new_date = last_date + timedelta(days=7)
+        while new_date + timedelta(days=7) <= today:
+            new_data_url = base_url + 'fares_{:%y%m%d}.csv'.format(new_date + timedelta(days=7))
+            try:
+                written.update(util.append_data(tmp, new_data_url, raw=True))
+            except Exception:
+                print('Unexpected error:', sys.exc_info()[0])
+                print('The data link generated is: ', new_data_url)
+                break
+            weeks.append('{:%Y-%m-%d}'.format(new_date))
+            new_date += timedelta(days=7)
+        if written:
+            commit_message = 'Data Updated - {} ({})'.format(
+                today.strftime('%Y-%m-%d %H:%M:%S'), ', '.join(weeks))
+            publisher.publish(sorted(written), commit_message)
+            print(commit_message)
+    return weeks
+
+
+if __name__ == '__main__':
+    if 'DATA_URL' in os.environ:
+        data_url = os.environ['DATA_URL']
+        publisher = GithubPublisher(os.environ['GITHUB_TOKEN'])
+    else:
+        data_url = 'data/'
+        publisher = LocalGitPublisher(os.path.dirname(os.path.abspath(__file__)))
+    update(data_url, publisher)
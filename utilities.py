@@ -1,7 +1,14 @@
 import pandas as pd
 import os
+import re
+import time
+import store
+import requests
+from io import BytesIO
 from datetime import timedelta, datetime
 from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 """
 Note from http://web.mta.info/developers/fare.html:
@@ -16,8 +23,73 @@ through Friday, January 7. The file labeled January 22 has data covering the per
 January 8, through Friday, January 14. And so on and so forth.
 """
 
-def download_files(begin_week, num_weeks, save_dir):
+MTA_FARES_URL = 'http://web.mta.info/developers/data/nyct/fares/'
+
+def download_week(session, report_week, save_dir, base_url=MTA_FARES_URL, retries=3, backoff=1.0):
     """   
+    Parameters
+    ----------
+    session : requests.Session
+        Session to reuse the HTTP connections.
+    report_week : datetime
+        Posting date of the file.
+    save_dir : str
+        Directory to save the files. The raw file is kept in save_dir/raw.
+    base_url : str, optional
+        Location of the fares_YYMMDD.csv files. The default is MTA_FARES_URL.
+    retries : int, optional
+        Number of retries after a connection error or a 5xx response, other
+        errors are raised at once. The default is 3.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled for every retry. The 
+        default is 1.0.
+
+    Returns
+    -------
+    data_name : str
+        Name of the saved file.
+    downloaded : boolean
+        False if the file was already on disk.
+    """
+    data_week = report_week - timedelta(days=7)
+    file_name = 'fares_{:%y%m%d}.csv'.format(report_week)
+    data_name = '{:%y%m%d}'.format(data_week) + '.csv'
+    data_path = os.path.join(save_dir, data_name)
+    raw_path = os.path.join(save_dir, 'raw', file_name)
+    if os.path.exists(data_path):
+        return data_name, False
+    if os.path.exists(raw_path):
+        with open(raw_path, 'rb') as f:
+            content = f.read()
+    else:
+        for attempt in range(retries + 1):
+            try:
+                response = session.get(base_url + file_name, timeout=60)
+                response.raise_for_status()
+                break
+            except requests.RequestException as e:
+                # A 4xx, such as a week not posted yet, will not succeed on retry.
+                status = e.response.status_code if e.response is not None else None
+                if attempt == retries or (status is not None and status < 500):
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+        content = response.content
+        with open(raw_path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(raw_path + '.tmp', raw_path)
+    df = pd.read_csv(BytesIO(content), skiprows=2, index_col=False)
+    df = df.drop(columns=[column for column in df.columns.tolist() if column.isspace()])
+    df.to_csv(data_path + '.tmp', index=False)
+    os.replace(data_path + '.tmp', data_path)
+    return data_name, True
+
+
+def download_files(begin_week, num_weeks, save_dir, max_workers=4, base_url=MTA_FARES_URL, 
+                   retries=3, backoff=1.0):
+    """   
+    Download the weeks concurrently over one pooled session. Weeks already 
+    on disk are skipped, so an interrupted run can simply be restarted.
+
     Parameters
     ----------
     begin_week : str
@@ -26,32 +98,145 @@ def download_files(begin_week, num_weeks, save_dir):
         Number of weeks to download starting from begin_week.
     save_dir : str
         Directory to save the files.
+    max_workers : int, optional
+        Number of weeks downloaded at the same time. The default is 4.
+    base_url : str, optional
+        Location of the fares_YYMMDD.csv files. The default is MTA_FARES_URL.
+    retries : int, optional
+        Number of retries after a connection error or a 5xx response, other
+        errors are raised at once. The default is 3.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled for every retry. The 
+        default is 1.0.
 
     Returns
     -------
-    None.
+    summary : dict
+        Names of the files 'downloaded' and 'skipped', and the error of each
+        'failed' week.
     """
     begin_week = datetime.strptime(begin_week, '%y%m%d')
-    for i in range(num_weeks):
-   		print('Downloading Week ' + str(i+1) + '/' + str(num_weeks) + '...')
-   		report_week = begin_week + timedelta(days= i * 7)
-   		data_week =  report_week - timedelta(days=7)
-   		file_name = '{:%y%m%d}'.format(report_week) + '.csv'
-   		data_name = '{:%y%m%d}'.format(data_week) + '.csv'
-   		link = 'http://web.mta.info/developers/data/nyct/fares/fares_' + file_name
-   		df = pd.read_csv(link, skiprows=2, index_col=False)
-   		df = df.drop(columns=[column for column in df.columns.tolist() if column.isspace()])
-   		df.to_csv(os.path.join(save_dir, data_name), index=False)
+    os.makedirs(os.path.join(save_dir, 'raw'), exist_ok=True)
+    summary = {'downloaded': [], 'skipped': [], 'failed': {}}
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for i in range(num_weeks):
+                report_week = begin_week + timedelta(days= i * 7)
+                future = executor.submit(download_week, session, report_week, save_dir, 
+                                         base_url, retries, backoff)
+                futures[future] = 'fares_{:%y%m%d}.csv'.format(report_week)
+            for future in tqdm(as_completed(futures), total=num_weeks):
+                try:
+                    data_name, downloaded = future.result()
+                    summary['downloaded' if downloaded else 'skipped'].append(data_name)
+                except Exception as e:
+                    summary['failed'][futures[future]] = repr(e)
+    summary['downloaded'].sort()
+    summary['skipped'].sort()
+    return summary
         
 
-def add_data(df, data_path):
+def week_of(data_path, raw=False):
+    """
+    Returns the WEEK of a weekly data file as YYYY-MM-DD, from its file name.
+    A raw MTA file is named by its posting date, a week after the WEEK.
+    """
+    data_date = datetime.strptime(data_path[-10:-4], '%y%m%d')
+    if raw:
+        data_date = data_date - timedelta(days=7)
+    return '{:%Y-%m-%d}'.format(data_date)
+
+
+def strip_categorical(series):
+    """
+    Strip the padding of a string column and make it categorical, stripping
+    each distinct value once instead of every row.
+    """
+    codes, uniques = pd.factorize(series)
+    category_codes, categories = pd.factorize(pd.Index(uniques).str.strip())
+    return pd.Categorical.from_codes(category_codes[codes], categories)
+
+
+def iter_week(data_path, chunksize=100000, raw=False):
+    """
+    Parse a weekly data file in chunks of bounded size.
+
+    The header is normalized once: blank columns are dropped and the names
+    stripped. Rows without REMOTE or STATION are dropped, and unparsable
+    counts are read as 0.
+
+    Parameters
+    ----------
+    data_path : str
+        Path or MTA link of a weekly data file.
+    chunksize : int, optional
+        Number of rows per chunk. The default is 100000.
+    raw : boolean, optional
+        The file is a fares_YYMMDD.csv as posted by the MTA, with two lines
+        before the header. The default is False, a YYMMDD.csv file saved by
+        download_week.
+
+    Yields
+    ------
+    chunk : pandas.DataFrame
+        Normalized rows of the week, see store.normalize_frame.
+    """
+    skiprows = 2 if raw else 0
+    week = pd.Timestamp(week_of(data_path, raw))
+    columns, names = None, None
+    with pd.read_csv(data_path, skiprows=skiprows, index_col=False, chunksize=chunksize) as reader:
+        for chunk in reader:
+            if columns is None:
+                columns = [column for column in chunk.columns if not column.isspace()]
+                names = [column.strip() for column in columns]
+            chunk = chunk[columns]
+            chunk.columns = names
+            chunk = chunk[chunk['REMOTE'].notna() & chunk['STATION'].notna()]
+            chunk = pd.DataFrame({
+                'REMOTE': strip_categorical(chunk['REMOTE']),
+                'STATION': strip_categorical(chunk['STATION']),
+                **{card: pd.to_numeric(pd.to_numeric(chunk[card], errors='coerce').fillna(0), downcast='integer')
+                   for card in store.card_columns(chunk)},
+                'WEEK': week
+                })
+            yield chunk
+
+
+def read_week(data_path, raw=False):
+    """
+    Parameters
+    ----------
+    data_path : str
+        Path or MTA link of a weekly data file.
+    raw : boolean, optional
+        The file is as posted by the MTA, see iter_week. The default is False.
+
+    Returns
+    -------
+    new_data : pandas.DataFrame
+        Normalized data of the week.
+    """
+    chunks = list(iter_week(data_path, raw=raw))
+    if len(chunks) == 1:
+        return chunks[0]
+    return store.normalize_frame(pd.concat(chunks, ignore_index=True))
+
+
+def add_data(df, data_path, raw=False):
     """
     Parameters
     ----------
     df : str or pandas.DataFrame
-        Path to the existing main data file, or existing pandas.DataFrame.
+        Path to the existing main data file or store directory, or existing 
+        pandas.DataFrame.
     data_dir : str
         Path to the new data file.
+    raw : boolean, optional
+        The file is as posted by the MTA, see iter_week. The default is False.
 
     Returns
     -------
@@ -61,23 +246,17 @@ def add_data(df, data_path):
         Signal whether the new data is successfully added.    
     """
     if isinstance(df, str) :
-        df = pd.read_csv(df)
+        if df.endswith('.csv'):
+            df = store.normalize_frame(pd.read_csv(df))
+        else:
+            df = store.read_store(df)
     if df is None:
-        df = pd.DataFrame()    
-    if 'web.mta.info' in data_path:
-        new_data = pd.read_csv(data_path, skiprows=2, index_col=False)
-        file_date = datetime.strptime(data_path[-10:-4], '%y%m%d')
-        data_date = file_date - timedelta(days=7)
-        new_data['WEEK'] = '{:%Y-%m-%d}'.format(data_date)
-    else:
-        new_data = pd.read_csv(data_path)
-        new_data['WEEK'] = '{:%Y-%m-%d}'.format(datetime.strptime(data_path[-10:-4], '%y%m%d'))
-    new_data = new_data.drop(columns=[column for column in new_data.columns.tolist() if column.isspace()])
-    new_data.columns = [column.strip() for column in new_data.columns.tolist()]
-    new_data['STATION'] = new_data['STATION'].apply(lambda x: x.strip())
-    if new_data['WEEK'].unique()[0] not in df['WEEK'].unique().tolist():
-        df = df.append(new_data)
-        df.index = range(len(df))
+        df = pd.DataFrame(columns=['WEEK'])
+    elif len(df):
+        df = store.normalize_frame(df)
+    new_data = read_week(data_path, raw)
+    if not df['WEEK'].isin([new_data['WEEK'].iloc[0]]).any():
+        df = store.normalize_frame(pd.concat([df, new_data], ignore_index=True))
         added = True
         print('New data added.')
     else:
@@ -85,30 +264,109 @@ def add_data(df, data_path):
         print('Data already in existing data frame. No new data added.')
     return df, added
 
+
+def append_data(store_dir, data_path, raw=False):
+    """
+    Append-only ingestion: the new week is streamed from the file into its 
+    own partition of the store and listed in the manifest, without loading 
+    the existing data or the whole file.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory of the store.
+    data_path : str
+        Path to the new data file.
+    raw : boolean, optional
+        The file is as posted by the MTA, see iter_week. The default is False.
+
+    Returns
+    -------
+    written : list
+        Paths of the partition and manifest written, empty when the week is 
+        already in the store.
+    """
+    written = store.append_chunks(iter_week(data_path, raw=raw), week_of(data_path, raw), store_dir)
+    if written:
+        print('New data added.')
+    else:
+        print('Data already in existing store. No new data added.')
+    return written
+
+	
+def read_file(data_path):
+    """
+    Parameters
+    ----------
+    data_path : str
+        Path to a weekly data file.
+
+    Returns
+    -------
+    new_data : pandas.DataFrame
+        Normalized data of the week, None if the file could not be parsed.
+    report : dict
+        File, week, rows, parse time in seconds and error message.
+    """
+    start = time.perf_counter()
+    new_data, week, error = None, None, None
+    try:
+        new_data = read_week(data_path)
+        week = '{:%Y-%m-%d}'.format(new_data['WEEK'].iloc[0])
+    except Exception as e:
+        error = repr(e)
+    report = {'file': data_path,
+              'week': week,
+              'rows': 0 if new_data is None else len(new_data),
+              'seconds': time.perf_counter() - start,
+              'error': error}
+    return new_data, report
+
 	
-def combine_all(load_dir):
+def combine_all(load_dir, processes=None):
     """
+    Parse all weekly files in parallel and concatenate them once.
+
     Parameters
     ----------
     load_dir : str
-        Directory storing all data files.
+        Directory storing all data files, named by week as YYMMDD.csv.
+    processes : int, optional
+        Size of the process pool; 1 parses in the current process. The 
+        default is None, one process per CPU.
 
     Returns
     -------
     df : pandas.DataFrame
-        Combined data frame.
+        Combined data frame, one file per WEEK. Empty when no file parsed.
+    report : pandas.DataFrame
+        Per-file week, rows, parse time and error, with duplicated weeks 
+        marked as skipped.
     """
-    file_names = os.listdir(load_dir)
-    for idx, file in tqdm(enumerate(file_names)):
-        data_dir = os.path.join(load_dir, file)
-        if idx == 0:
-            df = add_data(None, data_dir)
-        else:
-            df = add_data(df, data_dir)
-    return df
+    file_names = sorted(file for file in os.listdir(load_dir) if re.fullmatch(r'\d{6}\.csv', file))
+    data_paths = [os.path.join(load_dir, file) for file in file_names]
+    if processes == 1:
+        results = list(map(read_file, tqdm(data_paths)))
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(tqdm(executor.map(read_file, data_paths, chunksize=8), total=len(data_paths)))
+    frames, reports, weeks = [], [], set()
+    for new_data, report in results:
+        report['skipped'] = new_data is None or report['week'] in weeks
+        if not report['skipped']:
+            frames.append(new_data)
+            weeks.add(report['week'])
+        reports.append(report)
+    report = pd.DataFrame(reports, columns=['file', 'week', 'rows', 'seconds', 'error', 'skipped'])
+    for row in report[report['error'].notna()].itertuples():
+        print('Failed to parse', row.file + ':', row.error)
+    if not frames:
+        frames = [pd.DataFrame(columns=store.ID_COLUMNS + ['WEEK'])]
+    df = store.normalize_frame(pd.concat(frames, ignore_index=True))
+    return df, report
 	
 	
-def read_data(df_file='main.csv', files_dir='data', save_df='main.csv'):
+def read_data(df_file='main.csv', files_dir='data', store_dir='data/store'):
     """
     Parameters
     ----------
@@ -116,29 +374,36 @@ def read_data(df_file='main.csv', files_dir='data', save_df='main.csv'):
         Path to the main data frame file. The default is 'main.csv'.
     files_dir : str, optional
         Directory to the files. The default is 'data'.
-    save_df : str, optional
-        Path to where the data to save. The default is 'main.csv'.
+    store_dir : str, optional
+        Directory of the columnar store to load from, or to write to when it 
+        does not exist yet. The default is 'data/store'.
 
     Returns
     -------
     df : pandas.DataFrame
-        DESCRIPTION.
+        Normalized main data frame.
     """
+    if store_dir is not None and os.path.exists(os.path.join(store_dir, store.MANIFEST)):
+        return store.read_store(store_dir)
     if os.path.exists(df_file):
    		df = pd.read_csv(df_file)
     else:
-   		df = combine_all(files_dir)
-    if save_df is not None:
-   		df.to_csv(save_df, index=False)
-   		print('Saving main data frame as', save_df+'.')
-    return df
+   		df, _ = combine_all(files_dir)
+    if store_dir is not None:
+   		store.write_store(df, store_dir)
+   		print('Saving main data frame to', store_dir+'.')
+    return store.normalize_frame(df)
 
 	
 def main():
 	begin_week = input('Begin week (YYMMDD): ')
 	num_weeks = int(input('Number of weeks: '))
 	save_dir = input('Directory to save the file: ')
-	download_files(begin_week, num_weeks, save_dir)	
+	summary = download_files(begin_week, num_weeks, save_dir)
+	print('Downloaded:', len(summary['downloaded']), 'Skipped:', len(summary['skipped']), 
+	      'Failed:', len(summary['failed']))
+	for file_name, error in summary['failed'].items():
+		print(file_name, error)
 	
 
 if __name__ == '__main__':